@@ -0,0 +1,156 @@
+import os, sys
+import argparse
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+import ultrasound_tracking as ust
+
+# configure logging
+logging.basicConfig(format='%(levelname)s [%(asctime)s]: %(message)s', level=logging.INFO)
+
+METRICS = ('excursion', 'excursion_x', 'excursion_y', 'max_displacement', 'path_length')
+
+
+# relative displacement of every complete trial of one folder, including the zero displacement of the
+# first image, shape (trials, n, 2). returns the trial numbers and the trajectories, None if nothing to do.
+# without a tracking store loaded from the database the folder's tracking.json is read
+def folder_displacements(folder, imglist, tracking=None):
+    if len(imglist) < 2:
+        return None
+    if tracking is None:
+        path = os.path.join(folder, 'tracking.json')
+        if not os.path.exists(path):
+            return None
+        try:
+            tracking = ust.TrackingStore.load(path, 0, len(imglist))
+        except (ValueError, KeyError, IndexError, TypeError) as err:
+            logging.error('Cannot read ' + path + ': ' + format(err))
+            return None
+    trials = tracking.complete_trials()
+    if not len(trials):
+        return None
+    diff = tracking.point[trials, :, 0] - tracking.point[trials, :, 1]
+    return trials + 1, diff - diff[:, :1]
+
+
+# load the trajectories of all folders into one nan padded (sequences, images, 2) array. with a tracking
+# database the folders it contains are read from it
+def load_trajectories(folderlist, images, database=None, workers=ust.EXPORT_WORKERS):
+    imglists = {folder: images(folder) for folder in folderlist}
+    stores = database.load_all({folder: len(imglist) for folder, imglist in imglists.items()}) if database else {}
+    rows = []
+    trajectories = []
+    with ThreadPoolExecutor(workers) as executor:
+        for folder, result in zip(folderlist, executor.map(
+                lambda folder: folder_displacements(folder, imglists[folder], stores.get(folder)), folderlist)):
+            if result is None:
+                continue
+            for trial, trajectory in zip(*result):
+                rows.append((folder, int(trial), len(trajectory)))
+                trajectories.append(trajectory)
+
+    length = max((len(trajectory) for trajectory in trajectories), default=0)
+    data = np.full((len(trajectories), length, 2), np.nan)
+    for k, trajectory in enumerate(trajectories):
+        data[k, :len(trajectory)] = trajectory
+    return rows, data
+
+
+# metrics of all trajectories at once, padded images are nan and drop out of every reduction
+def displacement_metrics(data, lengths):
+    if not len(data):
+        return {metric: np.empty(0) for metric in METRICS}
+    final = data[np.arange(len(data)), lengths - 1]
+    distance = np.linalg.norm(data, axis=2)
+    steps = np.linalg.norm(np.diff(data, axis=1), axis=2)
+    return {'excursion': np.linalg.norm(final, axis=1),
+            'excursion_x': final[:, 0],
+            'excursion_y': final[:, 1],
+            'max_displacement': np.nanmax(distance, axis=1),
+            'path_length': np.nansum(steps, axis=1)}
+
+
+# one row per trial with the variables of its folder and the scaled displacement metrics
+def displacement_table(folderlist, config, images, database=None):
+    rows, data = load_trajectories(folderlist, images, database)
+    lengths = np.array([row[2] for row in rows], int)
+    metrics = displacement_metrics(data * float(config['scaling_factor']), lengths)
+
+    table = pd.DataFrame([ust.folder_to_vars(folder, config['variables']) for folder, trial, n in rows],
+                         columns=list(config['variables'].values()))
+    table['folder'] = [row[0] for row in rows]
+    table['trial'] = [row[1] for row in rows]
+    table['images'] = lengths
+    for metric in METRICS:
+        table[metric] = metrics[metric]
+    return table
+
+
+# mean, standard deviation and count of every metric per combination of the given variables
+def summarize(table, variables):
+    if not len(table):
+        return pd.DataFrame(columns=variables)
+    summary = table.groupby(variables)[list(METRICS)].agg(['mean', 'std', 'count'])
+    summary.columns = ['_'.join(column) for column in summary.columns]
+    return summary.reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute the relative displacement of object and fixpoint for '
+                                                 'all complete trials of all folders and summarize it per '
+                                                 'variable level.')
+    parser.add_argument('--config', default='tracking_config.txt', help='config file (default: %(default)s)')
+    parser.add_argument('--by', default=None,
+                        help='comma separated variables to group by (default: all but the last variable level)')
+    parser.add_argument('--trials', default='displacement.csv',
+                        help='per trial file name in the main folder (default: %(default)s)')
+    parser.add_argument('--summary', default='displacement_summary.csv',
+                        help='summary file name in the main folder (default: %(default)s)')
+    args = parser.parse_args()
+
+    try:
+        config = ust.read_config(args.config)
+    except FileNotFoundError as err:
+        logging.error('No config file found. ' + format(err))
+        sys.exit(1)
+
+    variables = list(config['variables'].values())
+    by = args.by.split(',') if args.by else variables[:-1] or variables
+    unknown = [variable for variable in by if variable not in variables]
+    if unknown:
+        logging.error('Unknown variables: ' + ', '.join(unknown))
+        sys.exit(1)
+
+    start = time.perf_counter()
+    walk_dir = os.path.abspath(config['folder'])
+    manifest = ust.DatasetManifest(walk_dir, config['image_format'])
+    manifest.load()
+    manifest.refresh()
+    database = None
+    if config.get('database', 'no').lower() in ('yes', 'true', '1'):
+        database = ust.TrackingDatabase(walk_dir)
+    try:
+        table = displacement_table(manifest.folderlist, config,
+                                   lambda folder: ust.open_frame_source(folder, manifest.images(folder)).names,
+                                   database)
+    finally:
+        if database is not None:
+            database.close()
+    summary = summarize(table, by)
+
+    try:
+        table.to_csv(os.path.join(walk_dir, args.trials), sep=';', decimal=',', index=False)
+        summary.to_csv(os.path.join(walk_dir, args.summary), sep=';', decimal=',', index=False)
+    except PermissionError as err:
+        logging.error('Cannot access output file: ' + format(err))
+        sys.exit(1)
+
+    logging.info('{0} trials of {1} folders in {2} groups summarized in {3:.2f} s'.format(
+        len(table), table['folder'].nunique(), len(summary), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
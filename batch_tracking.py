@@ -0,0 +1,176 @@
+import os, sys
+import argparse
+import csv
+import datetime, time
+import logging
+import multiprocessing
+import cv2
+import simplejson
+
+import ultrasound_tracking as ust
+
+# configure logging
+logging.basicConfig(format='%(levelname)s [%(asctime)s]: %(message)s', level=logging.INFO)
+
+
+def init_worker():
+    # one opencv thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+
+
+# seeds of a folder from the tracking database of the main folder, None if the folder is not in it. returns
+# the store and its snapshot, the main process writes only the rows the tracking changed
+def load_database(walk_dir, folder, n):
+    database = ust.TrackingDatabase(walk_dir)
+    try:
+        if not database.contains(folder):
+            return None, None
+        return database.load(folder, 0, n), database.saved[folder]
+    finally:
+        database.close()
+
+
+# track all seeded trials of one folder, returns a summary row and, with a tracking database, the tracked store
+# and its snapshot for the main process to save. without a database tracking.json is written back
+def track_folder(task):
+    folder, image_format, tracker_type, targets, pack, roi_margin, preprocess, walk_dir = task
+    summary = {'folder': folder, 'frames': 0, 'seeds': 0, 'tracked': 0, 'failed': 0, 'seconds': 0.0, 'status': ''}
+    start = time.perf_counter()
+    tracking = saved = None
+    try:
+        source = ust.open_frame_source(folder, ust.list_images(folder, image_format))
+        imglist = source.names
+        summary['frames'] = len(imglist)
+        if walk_dir is not None and len(imglist) >= 2:
+            tracking, saved = load_database(walk_dir, folder, len(imglist))
+        if tracking is None:
+            path = os.path.join(folder, 'tracking.json')
+            if not os.path.exists(path):
+                summary['status'] = 'no tracking.json'
+                return summary, None
+            with open(path) as f:
+                data = simplejson.load(f)
+            if len(imglist) < 2 or not data or len(data[0]) != len(imglist):
+                summary['status'] = 'skipped'
+                return summary, None
+            tracking = ust.TrackingStore.from_json(data, len(data), len(imglist))
+
+        stack = None
+        if pack:
+            stack = ust.open_frame_stack(folder, source, preprocess)
+            if stack is None:
+                stack = ust.pack_frame_stack(folder, source, preprocess)
+        if stack is not None:
+            frames = list(stack)
+        else:
+            frames = list(source.stream(range(len(source))))
+            if preprocess is not None:
+                frames = ust.preprocess_frames(frames, preprocess)
+        # all seeds of the folder are tracked together in one pass over the frames
+        seeds = [(trial, target) for trial in range(tracking.ntrials) for target in targets
+                 if tracking.get_rect(trial, 0, target)]
+        summary['seeds'] = len(seeds)
+        if seeds:
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            results, latencies = ust.track_sequence(tracker_type, frames,
+                                                    [tracking.get_rect(trial, 0, target) for trial, target in seeds],
+                                                    roi_margin, preprocess['scale'] if preprocess else 1.)
+            for (trial, target), rects in zip(seeds, results):
+                for k, rect in enumerate(rects, 1):
+                    if rect:
+                        tracking.set_rect(trial, k, target, rect, timestamp)
+                        summary['tracked'] += 1
+                    else:
+                        tracking.clear(trial, k, target)
+                        summary['failed'] += 1
+
+        if not summary['seeds']:
+            summary['status'] = 'no seeds'
+            return summary, None
+        summary['status'] = 'ok'
+        if walk_dir is not None:
+            return summary, (tracking, saved)
+        ust.write_json_atomic(path, tracking.to_json())
+    except Exception as err:
+        summary['status'] = 'error: ' + format(err)
+    finally:
+        summary['seconds'] = round(time.perf_counter() - start, 3)
+    return summary, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a tracker over all folders without the user interface. '
+                                                 'Seed rectangles are taken from the first image of every trial '
+                                                 'in the existing tracking.json files, or in tracking.sqlite with '
+                                                 'database = yes.')
+    parser.add_argument('--config', default='tracking_config.txt', help='config file (default: %(default)s)')
+    parser.add_argument('--tracker', default=ust.TRACKER_TYPES[1], choices=ust.TRACKER_TYPES,
+                        help='tracking algorithm (default: %(default)s)')
+    parser.add_argument('--targets', default='nerve,fix', help='objects to track (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--pack', action='store_true',
+                        help='read frames from (and create) memory mapped frames.npy stacks in each folder')
+    parser.add_argument('--summary', default='batch_summary.csv',
+                        help='summary file name in the main folder (default: %(default)s)')
+    args = parser.parse_args()
+
+    try:
+        config = ust.read_config(args.config)
+    except FileNotFoundError as err:
+        logging.error('No config file found. ' + format(err))
+        sys.exit(1)
+
+    walk_dir = os.path.abspath(config['folder'])
+    folderlist = ust.find_leaf_folders(walk_dir)
+    targets = args.targets.split(',')
+    roi_margin = float(config.get('roi_margin', 0))
+    preprocess = ust.preprocess_params(config)
+    # with database = yes the seeds are read from tracking.sqlite (tracking.json for folders not in it) and
+    # the results are written to it by this process only
+    database = None
+    if config.get('database', 'no').lower() in ('yes', 'true', '1'):
+        database = ust.TrackingDatabase(walk_dir)
+    tasks = [(folder, config['image_format'], args.tracker, targets, args.pack, roi_margin, preprocess,
+              walk_dir if database is not None else None)
+             for folder in folderlist]
+    logging.info('Tracking {0} folders with {1} on {2} workers'.format(len(tasks), args.tracker, args.workers))
+
+    start = time.perf_counter()
+    summaries = []
+    with multiprocessing.Pool(args.workers, initializer=init_worker) as pool:
+        for summary, result in pool.imap_unordered(track_folder, tasks):
+            if result is not None:
+                tracking, saved = result
+                if saved is not None:
+                    database.saved[summary['folder']] = saved
+                database.save(summary['folder'], tracking)
+            summaries.append(summary)
+            if summary['status'].startswith('error'):
+                logging.error(summary['folder'] + ': ' + summary['status'])
+            else:
+                logging.info('{0}: {1}, {2} tracked, {3} failed in {4} s'.format(
+                    summary['folder'].replace(walk_dir, ''), summary['status'], summary['tracked'],
+                    summary['failed'], summary['seconds']))
+
+    if database is not None:
+        database.close()
+    summaries.sort(key=lambda row: row['folder'])
+    try:
+        with open(os.path.join(walk_dir, args.summary), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(summaries[0].keys()) if summaries else ['folder'],
+                                    delimiter=';')
+            writer.writeheader()
+            writer.writerows(summaries)
+    except PermissionError as err:
+        logging.error('Cannot access summary file: ' + format(err))
+
+    logging.info('{0} folders, {1} seeds, {2} frames tracked, {3} failures, {4} errors in {5:.1f} s'.format(
+        len(summaries), sum(row['seeds'] for row in summaries), sum(row['tracked'] for row in summaries),
+        sum(row['failed'] for row in summaries),
+        sum(row['status'].startswith('error') for row in summaries), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
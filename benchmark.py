@@ -0,0 +1,146 @@
+import os, sys
+import argparse
+import datetime, time
+import logging
+import multiprocessing
+import platform
+import tracemalloc
+import cv2
+import numpy as np
+import simplejson
+
+import ultrasound_tracking as ust
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# configure logging
+logging.basicConfig(format='%(levelname)s [%(asctime)s]: %(message)s', level=logging.INFO)
+
+
+# frames and seeds of every folder, with the stored points of all following frames as reference
+def load_sequences(walk_dir, image_format):
+    sequences = []
+    for folder in sorted(ust.find_leaf_folders(walk_dir)):
+        source = ust.open_frame_source(folder, ust.list_images(folder, image_format))
+        path = os.path.join(folder, 'tracking.json')
+        if len(source) < 2 or not os.path.exists(path):
+            continue
+        tracking = ust.TrackingStore.load(path, 0, len(source))
+        frames = list(source.stream(range(len(source))))
+        for trial in range(tracking.ntrials):
+            for o, target in enumerate(ust.TrackingStore.objects):
+                seed = tracking.get_rect(trial, 0, target)
+                if seed:
+                    reference = np.where(tracking.valid[trial, 1:, o, None], tracking.point[trial, 1:, o], np.nan)
+                    sequences.append({'folder': folder, 'trial': trial + 1, 'target': target, 'frames': frames,
+                                      'seed': seed, 'reference': reference})
+    return sequences
+
+
+# runs in its own process so the peak memory belongs to this tracker alone
+def benchmark_tracker(task):
+    tracker_type, walk_dir, image_format, margin, repeat = task
+    cv2.setNumThreads(1)
+    sequences = load_sequences(walk_dir, image_format)
+
+    latencies = []
+    drift = []
+    final_drift = []
+    failures = 0
+    frames = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        for k in range(repeat):
+            for sequence in sequences:
+                rects, latency = ust.track_frames(tracker_type, sequence['frames'], sequence['seed'], margin)
+                latencies.extend(latency)
+                frames += len(rects)
+                failures += sum(rect is None for rect in rects)
+                if k == 0:
+                    centres = np.array([[(rect['x1'] + rect['x2']) / 2, (rect['y1'] + rect['y2']) / 2]
+                                        if rect else [np.nan, np.nan] for rect in rects])
+                    distance = np.linalg.norm(centres - sequence['reference'], axis=1)
+                    drift.extend(distance[np.isfinite(distance)])
+                    if np.isfinite(distance[-1]):
+                        final_drift.append(distance[-1])
+    except (ValueError, cv2.error) as err:
+        tracemalloc.stop()
+        return tracker_type, {'error': format(err)}
+    seconds = time.perf_counter() - start
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    result = {'sequences': len(sequences),
+              'frames': frames,
+              'seconds': round(seconds, 4),
+              'fps': round(frames / seconds, 2) if seconds else None,
+              'latency_ms': {'mean': round(float(latencies.mean()), 3),
+                             'p50': round(float(np.percentile(latencies, 50)), 3),
+                             'p90': round(float(np.percentile(latencies, 90)), 3),
+                             'p99': round(float(np.percentile(latencies, 99)), 3),
+                             'max': round(float(latencies.max()), 3)} if len(latencies) else None,
+              'traced_peak_mb': round(traced_peak / 2 ** 20, 2),
+              'failures': failures,
+              'failure_rate': round(failures / frames, 4) if frames else None,
+              'drift_px': {'mean': round(float(np.mean(drift)), 2),
+                           'max': round(float(np.max(drift)), 2),
+                           'final_mean': round(float(np.mean(final_drift)), 2) if final_drift else None}
+              if drift else None}
+    if resource is not None:
+        # kilobytes on linux, bytes on macos
+        scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+        result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 2)
+    return tracker_type, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tracking algorithms on annotated sequences. '
+                                                 'Every trial is tracked from its first rectangle and compared '
+                                                 'to the stored points of the following images.')
+    parser.add_argument('--folder', default=os.path.join('sampledata', 'BCP01'),
+                        help='main folder with annotated sequences (default: %(default)s)')
+    parser.add_argument('--image-format', default='TIF', help='image file ending (default: %(default)s)')
+    parser.add_argument('--trackers', default=','.join(ust.TRACKER_TYPES),
+                        help='comma separated tracker types (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per sequence (default: %(default)s)')
+    parser.add_argument('--roi-margin', type=float, default=0., help='search window margin (default: full frame)')
+    parser.add_argument('--output', default='benchmark.json', help='result file (default: %(default)s)')
+    args = parser.parse_args()
+
+    walk_dir = os.path.abspath(args.folder)
+    report = {'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+              'python': platform.python_version(),
+              'opencv': cv2.__version__,
+              'platform': platform.platform(),
+              'folder': walk_dir,
+              'repeat': args.repeat,
+              'roi_margin': args.roi_margin,
+              'trackers': {}}
+
+    # one fresh process per tracker, run one after the other so timings do not interfere
+    context = multiprocessing.get_context('spawn')
+    for tracker_type in args.trackers.split(','):
+        with context.Pool(1) as pool:
+            tracker_type, result = pool.apply(benchmark_tracker, ((tracker_type, walk_dir, args.image_format,
+                                                                   args.roi_margin, args.repeat),))
+        report['trackers'][tracker_type] = result
+        if 'error' in result:
+            logging.warning('{0}: {1}'.format(tracker_type, result['error']))
+        else:
+            logging.info('{0}: {1} fps, p50 {2} ms, p99 {3} ms, {4} failures, mean drift {5} px'.format(
+                tracker_type, result['fps'], result['latency_ms']['p50'], result['latency_ms']['p99'],
+                result['failures'], result['drift_px']['mean'] if result['drift_px'] else '-'))
+
+    with open(args.output, 'w') as f:
+        f.write(simplejson.dumps(report, indent=4))
+    logging.info('Benchmark written to ' + args.output)
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
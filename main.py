@@ -1,7 +1,7 @@
-import sys
+import sys, time
+started = time.perf_counter()  # cold start is measured from here until the first image is on screen
 import cv2
 import logging
-import configparser
 
 import ultrasound_tracking as ust
 
@@ -16,16 +16,7 @@ def catch_errors():
 
 # read config
 try:
-    configfile = configparser.ConfigParser(allow_no_value=True)
-    configfile.read('tracking_config.txt')
-
-    config = {}
-    for keys in configfile['General']:
-        config[keys] = configfile['General'][keys]
-
-    config['variables'] = {}
-    for keys in configfile['Variables']:
-        config['variables'][keys] = configfile['Variables'][keys]
+    config = ust.read_config('tracking_config.txt')
 except FileNotFoundError as err:
     logging.error('No config file found. ' + format(err))
     catch_errors()
@@ -42,6 +33,8 @@ try:
     cv2.namedWindow('status', cv2.WINDOW_NORMAL)
     cv2.namedWindow('help', cv2.WINDOW_NORMAL)
     cv2.setMouseCallback('image', img.draw_shape)
+    img.dirty.add('help')
+    frame_interval = 1000 / float(config.get('max_fps', 30))
 except Exception as err:
     logging.error("Unexpected error: " + format(err))
     catch_errors()
@@ -51,17 +44,36 @@ except Exception as err:
 # main program loop
 while 1:
     try:
-        if(img.cvobj is not None):
+        # only push windows that changed, mouse moves since the last refresh are applied at once
+        img.apply_pending_move()
+        img.poll_job()
+        if 'image' in img.dirty and img.cvobj is not None:
             cv2.imshow('image', img.cvobj)
-        cv2.imshow('status', img.status)
-        if img.helpflag:
-            cv2.imshow('help', img.helpscreen)
-        else:
-            cv2.destroyWindow('help')
+        if 'status' in img.dirty:
+            cv2.imshow('status', img.status)
+        if 'help' in img.dirty:
+            if img.helpflag:
+                cv2.imshow('help', img.helpscreen)
+            else:
+                cv2.destroyWindow('help')
+        img.dirty.clear()
+        img.flush_plot()
 
-        k = cv2.waitKey(1) & 0xFF
+        # waitKey sleeps until the next refresh unless a key is pressed
+        k = cv2.waitKey(max(1, int(frame_interval))) & 0xFF
+        if img.figure is None:
+            # the first image has been painted, the plot window is opened only now
+            startup = time.perf_counter() - started
+            ust.PROFILER.record('startup', startup)
+            if startup > float(config.get('startup_budget', ust.STARTUP_BUDGET)):
+                logging.warning('Startup took {0:.2f} s, over the budget of {1} s'.format(
+                    startup, config.get('startup_budget', ust.STARTUP_BUDGET)))
+            else:
+                logging.info('First image shown after {0:.2f} s'.format(startup))
+            img.init_plot()
         # print(k)
         if k == 27:
+            img.cancel_job(wait=True)
             break
         elif k == ord('w'):
             img.prev_folder()
@@ -83,13 +95,33 @@ while 1:
             img.next_trial()
         elif k == ord('o'):
             img.export_data()
-        elif k in range(49, 56):
+        elif k in range(49, 58):
             img.tracker_type = ust.TRACKER_TYPES[k - 49]
             img.reload_status()
         elif k == ord('h'):
             img.helpflag = not img.helpflag
+            img.dirty.add('help')
+        elif k == ord('j'):
+            img.joint = not img.joint
+            img.reload_status()
+        elif k == ord('t'):
+            img.track_joint(all_trials=True)
+        elif k == ord('c'):
+            img.compare_trackers('nerve' if img.mode else 'fix')
+        elif k == ord('v'):
+            img.apply_comparison()
+        elif k == ord('x'):
+            img.cancel_job()
+        elif k == ord('p'):
+            img.profile_overlay = not img.profile_overlay
+            img.reload_status()
     except Exception as err:
         logging.error("Unexpected error: " + format(err))
         catch_errors()
 
+logging.info('Frame cache: ' + img.frame_cache.stats())
+img.frame_cache.close()
+img.manifest.flush()
+if img.database is not None:
+    img.database.close()
 cv2.destroyAllWindows()
@@ -0,0 +1,49 @@
+import os, sys
+import argparse
+import time
+import logging
+
+import ultrasound_tracking as ust
+
+# configure logging
+logging.basicConfig(format='%(levelname)s [%(asctime)s]: %(message)s', level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy the tracking.json files of all folders into the '
+                                                 'tracking.sqlite database of the main folder, or write them '
+                                                 'back from it.')
+    parser.add_argument('action', choices=('import', 'export'),
+                        help='import: tracking.json files into the database, export: database into tracking.json files')
+    parser.add_argument('--config', default='tracking_config.txt', help='config file (default: %(default)s)')
+    args = parser.parse_args()
+
+    try:
+        config = ust.read_config(args.config)
+    except FileNotFoundError as err:
+        logging.error('No config file found. ' + format(err))
+        sys.exit(1)
+
+    start = time.perf_counter()
+    walk_dir = os.path.abspath(config['folder'])
+    manifest = ust.DatasetManifest(walk_dir, config['image_format'])
+    manifest.load()
+    manifest.refresh()
+    folders = {folder: len(ust.open_frame_source(folder, manifest.images(folder)))
+               for folder in manifest.folderlist}
+
+    database = ust.TrackingDatabase(walk_dir)
+    try:
+        if args.action == 'import':
+            count = database.import_json(folders)
+            logging.info('{0} of {1} folders imported into {2}'.format(count, len(folders), database.path))
+        else:
+            count = database.export_json(folders)
+            logging.info('{0} of {1} folders exported from {2}'.format(count, len(folders), database.path))
+    finally:
+        database.close()
+    logging.info('Done in {0:.2f} s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
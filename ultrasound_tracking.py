@@ -1,11 +1,18 @@
 import os, sys
+import csv
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 import cv2
 import simplejson
 import datetime, time
 import logging
+import configparser
+import hashlib
+import sqlite3
+import threading, queue
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # global constants
 
@@ -13,7 +20,1213 @@ WHITE = (255, 255, 255)
 RED = (0, 0, 255)
 GREEN = (0, 255, 0)
 YELLOW = (0, 255, 255)
-TRACKER_TYPES = ('BOOSTING', 'MIL', 'KCF', 'TLD', 'MEDIANFLOW', 'GOTURN', 'MOSSE', 'CSRT')
+TRACKER_TYPES = ('BOOSTING', 'MIL', 'KCF', 'TLD', 'MEDIANFLOW', 'GOTURN', 'MOSSE', 'CSRT', 'LK')
+GRAYSCALE_TRACKERS = ('MEDIANFLOW', 'CSRT')  # give the same results on single channel frames
+FLOW_TRACKERS = ('LK',)  # sparse optical flow, all seeds are tracked together
+LK_PARAMS = {'winSize': (21, 21), 'maxLevel': 3,
+             'criteria': (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01)}
+FLOW_GRID = 5  # points per axis followed inside every rectangle
+FLOW_FB_ERROR = 1.  # pixels a point may miss its start when tracked back, worse points are ignored
+FRAME_CACHE_MB = 256
+PREFETCH_FOLDER_FRAMES = 4  # first frames of the next folder loaded in the background
+PLOT_INTERVAL = 0.25  # minimum seconds between two redraws of the trajectory plot
+EXPORT_WORKERS = 8
+RETRACK_TOLERANCE = 3.  # pixels between new and stored centre at which a re-track stops
+PROFILE_WINDOW = 50  # number of recent timings kept per hot path
+STARTUP_BUDGET = 2.  # seconds from program start until the first image is shown
+
+
+# rolling timings of the hot paths, optionally appended as json lines to a log file
+class Profiler:
+
+    def __init__(self, window=PROFILE_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.log = None
+        self.lock = threading.Lock()
+
+    def open_log(self, path):
+        self.log = open(path, 'a')
+
+    @contextmanager
+    def timed(self, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, **fields)
+
+    def record(self, name, seconds, **fields):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(seconds * 1000)
+            if self.log is not None:
+                fields.update({'event': name, 'time': time.time(), 'ms': round(seconds * 1000, 3)})
+                self.log.write(simplejson.dumps(fields) + '\n')
+                self.log.flush()
+
+    # name -> (last, mean, max) in milliseconds over the recent window
+    def stats(self):
+        with self.lock:
+            return {name: (samples[-1], sum(samples) / len(samples), max(samples))
+                    for name, samples in self.samples.items()}
+
+
+PROFILER = Profiler()
+
+
+def profiled(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with PROFILER.timed(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# memory bounded LRU cache of decoded single channel frames, keyed by path and mtime, and for frames of
+# multi-frame files also by the frame number
+class FrameCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.prefetch_worker, daemon=True)
+        self.worker.start()
+
+    @staticmethod
+    def key(path, page=None):
+        return (path, os.path.getmtime(path)) if page is None else (path, os.path.getmtime(path), page)
+
+    # with a frame number, loader(page) decodes the frame on a miss
+    def get(self, path, page=None, loader=None):
+        key = self.key(path, page)
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return frame
+            self.misses += 1
+        return self.load(key, loader)
+
+    def load(self, key, loader=None):
+        with PROFILER.timed('imread', file=os.path.basename(key[0])):
+            frame = cv2.imread(key[0], 0) if loader is None else loader(key[2])
+        if frame is None:
+            return frame
+        with self.lock:
+            if key not in self.frames:
+                self.frames[key] = frame
+                self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes and len(self.frames) > 1:
+                _, old = self.frames.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return frame
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.frames
+
+    # replace any pending prefetch requests, items are paths or (path, page, loader). frames already in the
+    # cache are not queued again
+    def prefetch(self, items):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        for item in items:
+            path, page, loader = item if isinstance(item, tuple) else (item, None, None)
+            try:
+                key = self.key(path, page)
+            except OSError as err:
+                logging.debug('Prefetch failed: ' + format(err))
+                continue
+            if not self.contains(key):
+                self.queue.put((key, loader))
+
+    def prefetch_worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            key, loader = item
+            try:
+                if not self.contains(key):
+                    self.load(key, loader)
+            except OSError as err:
+                logging.debug('Prefetch failed: ' + format(err))
+
+    # drop the pending prefetch requests and wait for the frame being decoded, the worker must not be inside
+    # opencv when the interpreter exits
+    def close(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.queue.put(None)
+        self.worker.join()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return '{0} hits, {1} misses ({2:.0%} hit rate), {3} frames, {4:.1f} / {5:.1f} MB'.format(
+                self.hits, self.misses, self.hits / total if total else 0, len(self.frames),
+                self.nbytes / 2 ** 20, self.max_bytes / 2 ** 20)
+
+
+# opencv constructor for each tracker type, newer opencv builds keep some of them in cv2.legacy
+TRACKER_CONSTRUCTORS = {'BOOSTING': 'TrackerBoosting_create',
+                        'MIL': 'TrackerMIL_create',
+                        'KCF': 'TrackerKCF_create',
+                        'TLD': 'TrackerTLD_create',
+                        'MEDIANFLOW': 'TrackerMedianFlow_create',
+                        'GOTURN': 'TrackerGOTURN_create',
+                        'MOSSE': 'TrackerMOSSE_create',
+                        'CSRT': 'TrackerCSRT_create'}
+
+
+def read_config(path):
+    configfile = configparser.ConfigParser(allow_no_value=True)
+    if not configfile.read(path):
+        raise FileNotFoundError(path)
+
+    config = {}
+    for keys in configfile['General']:
+        config[keys] = configfile['General'][keys]
+
+    config['variables'] = {}
+    for keys in configfile['Variables']:
+        config['variables'][keys] = configfile['Variables'][keys]
+    return config
+
+
+def find_leaf_folders(walk_dir):
+    folderlist = []
+    for root, subdirs, files in os.walk(walk_dir):
+        if not subdirs:
+            folderlist.append(root)
+    return folderlist
+
+
+# on-disk list of all directories below the main folder with their subfolders and sorted images
+# entries are rescanned only when the directory mtime changed
+class DatasetManifest:
+    filename = 'manifest.json'
+
+    def __init__(self, walk_dir, image_format):
+        self.walk_dir = walk_dir
+        self.image_format = image_format
+        self.path = os.path.join(walk_dir, self.filename)
+        self.dirs = {}  # relative path -> {'mtime', 'subdirs', 'images'}
+        self.folderlist = []
+        self.unsaved = False  # folders rescanned by images() since the last save
+        self.lock = threading.Lock()
+
+    def abspath(self, rel):
+        return os.path.join(self.walk_dir, rel) if rel else self.walk_dir
+
+    def relpath(self, folder):
+        rel = os.path.relpath(folder, self.walk_dir)
+        return '' if rel == '.' else rel
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = simplejson.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('image_format') != self.image_format:
+            return False
+        self.dirs = data['dirs']
+        self.folderlist = self.leaf_folders()
+        return True
+
+    def save(self):
+        with self.lock:
+            data = {'image_format': self.image_format, 'dirs': dict(self.dirs)}
+            self.unsaved = False
+            try:
+                write_json_atomic(self.path, data, indent=None)
+                # writing the manifest changed the mtime of the main folder, it is not a change of the dataset
+                if '' in self.dirs:
+                    self.dirs[''] = dict(self.dirs[''], mtime=os.stat(self.walk_dir).st_mtime)
+            except OSError as err:
+                logging.warning('Cannot write dataset manifest: ' + format(err))
+
+    def scan_dir(self, rel):
+        path = self.abspath(rel)
+        mtime = os.stat(path).st_mtime
+        subdirs, images = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith(self.image_format):
+                    images.append(entry.name)
+        return {'mtime': mtime, 'subdirs': sorted(subdirs), 'images': sorted(images)}
+
+    # stat every known directory and list only the ones that changed, returns True if folders or images were
+    # added or removed. files written by the tools themselves change a directory's mtime but not its listing,
+    # such a directory is listed again on the next refresh but the manifest is not rewritten
+    def refresh(self):
+        dirs = {}
+        changed = False
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            try:
+                entry = self.dirs.get(rel)
+                if entry is None or entry['mtime'] != os.stat(self.abspath(rel)).st_mtime:
+                    old, entry = entry, self.scan_dir(rel)
+                    if old is None or (old['subdirs'], old['images']) != (entry['subdirs'], entry['images']):
+                        changed = True
+            except OSError as err:
+                logging.debug('Skipping folder: ' + format(err))
+                continue
+            dirs[rel] = entry
+            stack.extend(os.path.join(rel, name) for name in entry['subdirs'])
+        changed = changed or dirs.keys() != self.dirs.keys()
+        with self.lock:
+            self.dirs = dirs
+            self.folderlist = self.leaf_folders()
+        if changed or self.unsaved:
+            self.save()
+        return changed
+
+    # leaf folders in the top-down order of os.walk
+    def leaf_folders(self):
+        folderlist = []
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            entry = self.dirs.get(rel)
+            if entry is None:
+                continue
+            if not entry['subdirs']:
+                folderlist.append(self.abspath(rel))
+            stack.extend(os.path.join(rel, name) for name in reversed(entry['subdirs']))
+        return folderlist
+
+    # image list of a folder, costs a single stat unless the folder changed. a rescanned folder is only
+    # updated in memory, saving the tracking.json changes the folder mtime on every edit
+    def images(self, folder):
+        rel = self.relpath(folder)
+        entry = self.dirs.get(rel)
+        if entry is None or entry['mtime'] != os.stat(folder).st_mtime:
+            entry = self.scan_dir(rel)
+            with self.lock:
+                self.dirs[rel] = entry
+                self.unsaved = True
+        return list(entry['images'])
+
+    # write the manifest if folders were rescanned since the last save, called on exit
+    def flush(self):
+        if self.unsaved:
+            self.save()
+
+    def cached_images(self, folder):
+        entry = self.dirs.get(self.relpath(folder))
+        return list(entry['images']) if entry else []
+
+
+def list_images(folder, image_format):
+    return sorted(file for file in os.listdir(folder) if file.endswith(image_format))
+
+
+VIDEO_FORMATS = ('.avi', '.mp4')
+CONTAINER_CHUNK = 32  # pages of a multi-page tiff decoded per read while streaming
+# older opencv builds (such as 3.3) can neither count the pages of a file nor read a range of them, there a
+# multi-page tiff is decoded as a whole once and kept by its frame source
+PAGE_RANGES = hasattr(cv2, 'imcount')
+
+
+# frames of a folder of single image files, named by their file names
+class ImageFolderSource:
+
+    def __init__(self, folder, imglist, cache=None):
+        self.folder = folder
+        self.names = imglist
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, k):
+        path = os.path.join(self.folder, self.names[k])
+        if self.cache is None:
+            return cv2.imread(path, 0)
+        return self.cache.get(path)
+
+    def prefetch_items(self, indices):
+        return [os.path.join(self.folder, self.names[k]) for k in indices]
+
+    def stream(self, indices):
+        return (self.get(k) for k in indices)
+
+    # file names and mtimes, a frame stack made from different files is out of date
+    def index(self):
+        return [[file, os.path.getmtime(os.path.join(self.folder, file))] for file in self.names]
+
+
+# frames of a multi-page tiff or a video file, named file#frame. single frames are decoded with a seek and
+# kept in the frame cache, stream decodes consecutive frames sequentially without the cache
+class ContainerSource:
+
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.cache = cache
+        self.video = path.lower().endswith(VIDEO_FORMATS)
+        self.lock = threading.Lock()
+        self.capture = None  # kept open for seeking in videos
+        self.position = 0
+        self.pages = None  # all pages of a multi-page tiff without PAGE_RANGES
+        if self.video:
+            capture = cv2.VideoCapture(path)
+            count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) if capture.isOpened() else 0
+            capture.release()
+        elif PAGE_RANGES:
+            count = cv2.imcount(path)
+        else:
+            ok, pages = cv2.imreadmulti(path, flags=0)
+            self.pages = pages if ok else []
+            count = len(self.pages)
+        name = os.path.basename(path)
+        self.names = ['{0}#{1:04d}'.format(name, k + 1) for k in range(count)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def read(self, k):
+        if self.pages is not None:
+            return self.pages[k] if k < len(self.pages) else None
+        if not self.video:
+            ok, frames = cv2.imreadmulti(self.path, start=k, count=1, flags=0)
+            return frames[0] if ok and frames else None
+        with self.lock:
+            if self.capture is None:
+                self.capture = cv2.VideoCapture(self.path)
+            if self.position != k:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, k)
+            ok, frame = self.capture.read()
+            self.position = k + 1
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if ok else None
+
+    def get(self, k):
+        if self.cache is None:
+            return self.read(k)
+        return self.cache.get(self.path, k, self.read)
+
+    def prefetch_items(self, indices):
+        return [(self.path, k, self.read) for k in indices]
+
+    # runs of consecutive frames are decoded in one sequential pass each
+    def stream(self, indices):
+        indices = list(indices)
+        while indices:
+            run = 1
+            while run < len(indices) and indices[run] == indices[run - 1] + 1:
+                run += 1
+            yield from self.decode(indices[0], run)
+            indices = indices[run:]
+
+    def decode(self, start, count):
+        if self.pages is not None:
+            yield from self.pages[start:start + count]
+            return
+        if not self.video:
+            for first in range(start, start + count, CONTAINER_CHUNK):
+                ok, frames = cv2.imreadmulti(self.path, start=first, flags=0,
+                                             count=min(CONTAINER_CHUNK, start + count - first))
+                yield from frames if ok else []
+            return
+        capture = cv2.VideoCapture(self.path)
+        try:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+            for k in range(count):
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        finally:
+            capture.release()
+
+    def index(self):
+        return [[os.path.basename(self.path), os.path.getmtime(self.path), len(self.names)]]
+
+
+# frame source of a folder: a single multi-page image or, without images, the first video file are read
+# frame by frame, otherwise every image is one frame
+def open_frame_source(folder, imglist, cache=None):
+    if len(imglist) == 1:
+        source = ContainerSource(os.path.join(folder, imglist[0]), cache)
+        if len(source) > 1:
+            return source
+    if not imglist:
+        videos = sorted(file for file in os.listdir(folder) if file.lower().endswith(VIDEO_FORMATS))
+        if videos:
+            return ContainerSource(os.path.join(folder, videos[0]), cache)
+    return ImageFolderSource(folder, imglist, cache)
+
+
+# frame names of a folder as the viewer lists them
+def frame_names(folder, image_format):
+    return open_frame_source(folder, list_images(folder, image_format)).names
+
+
+FRAME_STACK = 'frames.npy'
+FRAME_STACK_INDEX = 'frames.json'
+
+
+# preprocessing applied to the frames handed to the trackers, None if everything is switched off.
+# denoise is the (odd) median blur kernel size, clahe the contrast limit and scale the downscale factor
+def preprocess_params(config):
+    params = {'denoise': int(config.get('preprocess_denoise', 0)),
+              'clahe': float(config.get('preprocess_clahe', 0)),
+              'scale': float(config.get('preprocess_scale', 1))}
+    if params['denoise'] and not params['denoise'] % 2:
+        params['denoise'] += 1
+    if not 0 < params['scale'] <= 1:
+        raise ValueError('preprocess_scale must be larger than 0 and at most 1')
+    if not params['denoise'] and not params['clahe'] and params['scale'] == 1:
+        return None
+    return params
+
+
+# short hash of the parameters, names the cached stack so every setting gets its own file
+def preprocess_key(params):
+    return hashlib.sha1(simplejson.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def preprocess_frames(frames, params):
+    clahe = cv2.createCLAHE(clipLimit=params['clahe'], tileGridSize=(8, 8)) if params['clahe'] else None
+    result = []
+    for frame in frames:
+        if params['denoise']:
+            frame = cv2.medianBlur(frame, params['denoise'])
+        if clahe is not None:
+            frame = clahe.apply(frame)
+        if params['scale'] != 1:
+            frame = cv2.resize(frame, None, fx=params['scale'], fy=params['scale'], interpolation=cv2.INTER_AREA)
+        result.append(frame)
+    return result
+
+
+def frame_stack_names(params=None):
+    if params is None:
+        return FRAME_STACK, FRAME_STACK_INDEX
+    key = preprocess_key(params)
+    return 'frames_' + key + '.npy', 'frames_' + key + '.json'
+
+
+# memory mapped (n, H, W) uint8 stack of a folder's frames, None if missing or out of date. with params
+# the stack of the preprocessed frames
+def open_frame_stack(folder, source, params=None):
+    stack, stack_index = frame_stack_names(params)
+    try:
+        with open(os.path.join(folder, stack_index)) as f:
+            index = simplejson.load(f)
+        if index != simplejson.loads(simplejson.dumps(source.index())):
+            return None
+        return np.load(os.path.join(folder, stack), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+
+# decode (and preprocess) all frames of a folder into one .npy file next to tracking.json
+def pack_frame_stack(folder, source, params=None):
+    stack, stack_index = frame_stack_names(params)
+    index = source.index()
+    frames = list(source.stream(range(len(source))))
+    if len(frames) != len(source) or not frames or \
+            any(frame is None or frame.shape != frames[0].shape for frame in frames):
+        logging.warning('Cannot pack frames of ' + folder + ', images are unreadable or differ in size')
+        return None
+    if params is not None:
+        frames = preprocess_frames(frames, params)
+    path = os.path.join(folder, stack)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.stack(frames))
+        os.replace(path + '.tmp', path)
+        write_json_atomic(os.path.join(folder, stack_index), index)
+    except OSError as err:
+        logging.warning('Cannot write frame stack: ' + format(err))
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def create_tracker(tracker_type):
+    name = TRACKER_CONSTRUCTORS[tracker_type]
+    for module in (cv2, getattr(cv2, 'legacy', None)):
+        if hasattr(module, name):
+            return getattr(module, name)()
+    raise ValueError('Tracker ' + tracker_type + ' is not available in this OpenCV build')
+
+
+def rect_to_bbox(rect):
+    x1, y1, x2, y2 = rect.values()
+    return min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1)
+
+
+def rect_centre(rect):
+    return (rect['x1'] + rect['x2']) / 2, (rect['y1'] + rect['y2']) / 2
+
+
+def bbox_to_rect(bbox):
+    return {'x1': int(bbox[0]), 'y1': int(bbox[1]),
+            'x2': int(bbox[0] + bbox[2]),
+            'y2': int(bbox[1] + bbox[3])}
+
+
+# region of the image around bbox (x, y, w, h) that is handed to the tracker, as x1, y1, x2, y2
+def search_window(bbox, pad, shape):
+    return (max(0, int(bbox[0]) - pad), max(0, int(bbox[1]) - pad),
+            min(shape[1], int(bbox[0] + bbox[2]) + pad), min(shape[0], int(bbox[1] + bbox[3]) + pad))
+
+
+# true while bbox keeps half the padding to every window edge that is not an image border
+def inside_window(bbox, window, pad, shape):
+    x1, y1, x2, y2 = window
+    return ((x1 == 0 or bbox[0] - x1 >= pad / 2) and (y1 == 0 or bbox[1] - y1 >= pad / 2) and
+            (x2 == shape[1] or x2 - bbox[0] - bbox[2] >= pad / 2) and
+            (y2 == shape[0] or y2 - bbox[1] - bbox[3] >= pad / 2))
+
+
+# one tracker following one target through a sequence of single channel frames. with a margin > 0 the
+# tracker only sees a window around the target, padded by margin times the rectangle size. the window is
+# moved (and the tracker restarted) when the target comes close to its edge. frames downscaled by scale
+# take and return rects in the coordinates of the original images
+class SequenceTracker:
+
+    def __init__(self, tracker_type, frame, rect, margin=0., scale=1.):
+        self.tracker_type = tracker_type
+        self.margin = margin
+        self.scale = scale
+        self.shape = frame.shape
+        self.latencies = []  # seconds per tracker.update
+        self.start(frame, tuple(int(round(value * scale)) for value in rect_to_bbox(rect)))
+
+    def prepare(self, frame):
+        x1, y1, x2, y2 = self.window
+        if self.tracker_type in GRAYSCALE_TRACKERS:
+            return np.ascontiguousarray(frame[y1:y2, x1:x2])
+        return cv2.cvtColor(frame[y1:y2, x1:x2], 8)
+
+    def start(self, frame, bbox):
+        if self.margin > 0:
+            self.pad = int(self.margin * max(bbox[2], bbox[3]))
+            self.window = search_window(bbox, self.pad, self.shape)
+        else:
+            self.window = (0, 0, self.shape[1], self.shape[0])
+        x1, y1 = self.window[:2]
+        self.tracker = create_tracker(self.tracker_type)
+        self.tracker.init(self.prepare(frame), (bbox[0] - x1, bbox[1] - y1, bbox[2], bbox[3]))
+
+    # rect on the next frame, None on failure
+    def update(self, frame):
+        x1, y1 = self.window[:2]
+        image = self.prepare(frame)
+        begin = time.perf_counter()
+        ok, bbox = self.tracker.update(image)
+        self.latencies.append(time.perf_counter() - begin)
+        PROFILER.record('tracker_update', self.latencies[-1], tracker=self.tracker_type)
+        if not ok:
+            return None
+        bbox = (bbox[0] + x1, bbox[1] + y1, bbox[2], bbox[3])
+        if self.margin > 0 and not inside_window(bbox, self.window, self.pad, self.shape):
+            self.start(frame, bbox)
+        return bbox_to_rect([value / self.scale for value in bbox])
+
+
+# pyramidal lucas-kanade optical flow on a small grid of points inside every seed rectangle. the points of
+# all seeds go through one forward and one backward call per frame pair, a rectangle moves by the median
+# shift of its points that came back to their start. the rectangles keep their size, and a seed stays
+# lost once none of its points could be followed
+class FlowTracker:
+
+    def __init__(self, frame, rects, scale=1.):
+        self.scale = scale
+        bboxes = np.array([rect_to_bbox(rect) for rect in rects], np.float32).reshape(-1, 4) * scale
+        self.size = bboxes[:, 2:]
+        self.centres = bboxes[:, :2] + self.size / 2
+        # grid over the inner half of each rectangle, relative to its centre
+        grid = np.linspace(-.25, .25, FLOW_GRID)
+        self.offsets = np.stack(np.meshgrid(grid, grid), axis=-1).reshape(1, -1, 2) * self.size[:, None]
+        self.lost = np.zeros(len(rects), bool)
+        self.previous = frame
+        self.latencies = []  # seconds per frame for all seeds together
+
+    # rects on the next frame, None for lost seeds
+    def update(self, frame):
+        begin = time.perf_counter()
+        points = (self.centres[:, None] + self.offsets).astype(np.float32).reshape(-1, 1, 2)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.previous, frame, points, None, **LK_PARAMS)
+        back, status_back, _ = cv2.calcOpticalFlowPyrLK(frame, self.previous, moved, None, **LK_PARAMS)
+        self.previous = frame
+        good = (status.ravel() == 1) & (status_back.ravel() == 1) & \
+               (np.linalg.norm((points - back).reshape(-1, 2), axis=1) < FLOW_FB_ERROR)
+        good = good.reshape(len(self.centres), -1)
+        shift = np.where(good[..., None], (moved - points).reshape(good.shape + (2,)), np.nan)
+        self.lost |= ~good.any(axis=1)
+        found = ~self.lost
+        self.centres[found] += np.nanmedian(shift[found], axis=1)
+        self.latencies.append(time.perf_counter() - begin)
+        PROFILER.record('tracker_update', self.latencies[-1], tracker='LK')
+        return [None if lost else bbox_to_rect(np.concatenate([centre - size / 2, size]) / self.scale)
+                for lost, centre, size in zip(self.lost, self.centres, self.size)]
+
+
+# track several seed rectangles on the first frame through the following ones, frames may be any iterable
+# and is only read as far as needed. yields per following frame the rect (or None on failure) and the
+# tracker.update duration of every seed
+def iter_sequence(tracker_type, frames, seeds, margin=0., scale=1., cancelled=None):
+    frames = iter(frames)
+    first = next(frames)
+    if tracker_type in FLOW_TRACKERS:
+        tracker = FlowTracker(first, seeds, scale)
+        for frame in frames:
+            if cancelled is not None and cancelled.is_set():
+                return
+            rects = tracker.update(frame)
+            # the cost of the batched update is shared among the seeds
+            yield rects, [tracker.latencies[-1] / len(seeds)] * len(seeds)
+        return
+    trackers = [SequenceTracker(tracker_type, first, seed, margin, scale) for seed in seeds]
+    for frame in frames:
+        if cancelled is not None and cancelled.is_set():
+            return
+        rects = [tracker.update(frame) for tracker in trackers]
+        yield rects, [tracker.latencies[-1] for tracker in trackers]
+
+
+# track several seed rectangles on frames[0] in a single pass over the frames, every tracker is updated
+# from the same frame. returns per seed one rect (or None on failure) per following frame and the
+# tracker.update durations per seed. once the optional cancelled event is set no further frames are tracked
+def track_sequence(tracker_type, frames, seeds, margin=0., scale=1., cancelled=None):
+    results = [[] for seed in seeds]
+    latencies = [[] for seed in seeds]
+    for rects, latency in iter_sequence(tracker_type, frames, seeds, margin, scale, cancelled):
+        for k, rect in enumerate(rects):
+            results[k].append(rect)
+            latencies[k].append(latency[k])
+    return results, latencies
+
+
+# single seed version of track_sequence
+def track_frames(tracker_type, frames, rect, margin=0., scale=1., cancelled=None):
+    results, latencies = track_sequence(tracker_type, frames, [rect], margin, scale, cancelled)
+    return results[0], latencies[0]
+
+
+# runs a tracking generator in a worker thread. every item it yields (one per image) is posted to a queue
+# that the main loop drains, None marks the end. opencv releases the gil during tracker.update, so the
+# user interface stays responsive while the worker runs
+class TrackingJob(threading.Thread):
+
+    def __init__(self, label, tracker_type, steps, total):
+        super().__init__(daemon=True)
+        self.label = label
+        self.tracker_type = tracker_type
+        self.steps = steps
+        self.total = total
+        self.done = 0  # steps applied by the main loop
+        self.latencies = []
+        self.error = None
+        self.result = {}
+        self.apply = None  # called by the main loop once the job completed
+        self.updates = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def run(self):
+        try:
+            for step in self.steps:
+                if self.cancelled.is_set():
+                    break
+                self.updates.put(step)
+        except Exception as err:
+            self.error = err
+        finally:
+            if hasattr(self.steps, 'close'):
+                self.steps.close()
+            self.updates.put(None)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    # items posted since the last call
+    def drain(self):
+        items = []
+        while True:
+            try:
+                items.append(self.updates.get_nowait())
+            except queue.Empty:
+                return items
+
+
+# run several tracker types concurrently from the same seed over the same frames, opencv releases the gil
+# during tracker.update. yields every tracker type as it finishes with its rects, the failed frame numbers
+# and the wall time. setting the optional cancelled event stops every tracker at its next frame
+def iter_comparison(tracker_types, frames, rect, margin=0., scale=1., cancelled=None):
+    def run(tracker_type):
+        start = time.perf_counter()
+        try:
+            rects, latencies = track_frames(tracker_type, frames, rect, margin, scale, cancelled)
+        except (ValueError, cv2.error) as err:
+            return {'error': format(err)}
+        return {'rects': rects,
+                'failures': [k for k, rect in enumerate(rects, 1) if rect is None],
+                'seconds': time.perf_counter() - start}
+
+    with ThreadPoolExecutor(len(tracker_types)) as executor:
+        futures = {executor.submit(run, tracker_type): tracker_type for tracker_type in tracker_types}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# fewest failures first, then the smallest mean distance to the median centre of all trackers, then speed
+def select_tracker(results):
+    valid = {tracker_type: result for tracker_type, result in results.items() if 'error' not in result}
+    if not valid:
+        return None
+    centres = {}
+    for tracker_type, result in valid.items():
+        centres[tracker_type] = np.array([[(rect['x1'] + rect['x2']) / 2, (rect['y1'] + rect['y2']) / 2]
+                                          if rect else [np.nan, np.nan] for rect in result['rects']], float)
+    consensus = np.nanmedian(np.stack(list(centres.values())), axis=0)
+
+    def score(tracker_type):
+        distance = np.linalg.norm(centres[tracker_type] - consensus, axis=1)
+        deviation = np.nanmean(distance) if np.isfinite(distance).any() else np.inf
+        return len(valid[tracker_type]['failures']), deviation, valid[tracker_type]['seconds']
+
+    return min(valid, key=score)
+
+
+def write_json_atomic(path, data, indent=4):
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f:
+        f.write(simplejson.dumps(data, indent=indent))
+    os.replace(tmppath, path)
+
+
+def folder_to_vars(folder, variables):
+    vars = variables.values()
+    varvals = folder.replace('/', '\\').split('\\')[-len(vars):]
+    var_dict = {key: value for key, value in zip(vars, varvals)}
+    return var_dict
+
+
+# output columns for all tracked points of a folder, rows ordered by trial, object and image
+def tracking_columns(tracking, folder, imglist, variables):
+    trial, o, k = np.nonzero(tracking.valid.transpose(0, 2, 1))
+    nrows = len(k)
+    columns = {'x': tracking.point[trial, k, o, 0], 'y': tracking.point[trial, k, o, 1]}
+    for key, value in folder_to_vars(folder, variables).items():
+        columns[key] = [value] * nrows
+    columns['folder'] = [folder] * nrows
+    columns['trial'] = trial + 1
+    columns['time'] = tracking.time[trial, k, o]
+    columns['file'] = np.array(imglist, dtype=str)[k]
+    columns['image_no'] = k + 1
+    columns['object'] = np.array(TrackingStore.objects)[o]
+    return columns
+
+
+# an export cache entry is valid while tracking.json, the scaling factor and the variables are unchanged
+def export_cache_key(folder, config):
+    stat = os.stat(os.path.join(folder, 'tracking.json'))
+    return [stat.st_mtime, stat.st_size, config['scaling_factor'], list(config['variables'].items())]
+
+
+# read one folder's tracking.json without touching the viewer, x and y are scaled for output
+# returns the columns (None if there is nothing to export) and the entry for the export cache
+def export_folder(folder, config, cache=None):
+    try:
+        key = export_cache_key(folder, config)
+    except OSError:
+        return None, None
+    key = simplejson.loads(simplejson.dumps(key))  # compare in the form read back from the cache file
+    if cache and folder in cache and cache[folder]['key'] == key:
+        return cache[folder]['columns'], cache[folder]
+
+    imglist = frame_names(folder, config['image_format'])
+    columns = None
+    if imglist:
+        path = os.path.join(folder, 'tracking.json')
+        try:
+            tracking = TrackingStore.load(path, 0, len(imglist))
+        except (ValueError, KeyError, IndexError, TypeError) as err:
+            logging.error('Cannot read ' + path + ': ' + format(err))
+            return None, None
+        columns = tracking_columns(tracking, folder, imglist, config['variables'])
+        if len(columns['x']):
+            scaling = float(config['scaling_factor'])
+            columns['x'] = columns['x'] * scaling
+            columns['y'] = columns['y'] * scaling
+            columns = {name: np.asarray(values).tolist() for name, values in columns.items()}
+        else:
+            columns = None
+    return columns, {'key': key, 'columns': columns}
+
+
+# yields export_folder results in folder order, with a bounded number of folders in flight
+def export_folders(folderlist, config, cache=None, workers=EXPORT_WORKERS):
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for folder in folderlist:
+            pending.append((folder, executor.submit(export_folder, folder, config, cache)))
+            if len(pending) >= 2 * workers:
+                folder, future = pending.popleft()
+                yield (folder,) + future.result()
+        while pending:
+            folder, future = pending.popleft()
+            yield (folder,) + future.result()
+
+
+def format_value(value):
+    if isinstance(value, (float, np.floating)):
+        return str(float(value)).replace('.', ',')
+    return str(value)
+
+
+# output columns of all folders read from the tracking database in one query, as export_folders yields them
+def database_folders(folderlist, config, database):
+    imglists = {folder: frame_names(folder, config['image_format']) for folder in folderlist}
+    stores = database.load_all({folder: len(imglist) for folder, imglist in imglists.items()})
+    scaling = float(config['scaling_factor'])
+    for folder in folderlist:
+        if folder not in stores:
+            # not imported into the database yet, read its tracking.json
+            yield folder, export_folder(folder, config)[0], None
+            continue
+        columns = tracking_columns(stores[folder], folder, imglists[folder], config['variables'])
+        if not len(columns['x']):
+            yield folder, None, None
+            continue
+        columns['x'] = columns['x'] * scaling
+        columns['y'] = columns['y'] * scaling
+        yield folder, {name: np.asarray(values).tolist() for name, values in columns.items()}, None
+
+
+# stream all folders into results.csv (';' separated, ',' decimal) and optionally a parquet file
+# rows of folders unchanged since the last export are taken from the cache file, with a tracking database
+# all rows are read from it instead, folders not in the database from their tracking.json
+def export_results(folderlist, config, path, parquet_path=None, cache_path=None, database=None):
+    parquet_writer = None
+    if parquet_path:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logging.error('Parquet output requires the pyarrow package.')
+            parquet_path = None
+
+    if database is not None:
+        cache_path = None
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = simplejson.load(f)
+        except ValueError as err:
+            logging.warning('Ignoring unreadable export cache: ' + format(err))
+    new_cache = {}
+    cached = 0
+
+    nrows = 0
+    header = None
+    with open(path, 'w') as f:
+        writer = csv.writer(f, delimiter=';', lineterminator='\n')
+        try:
+            if database is not None:
+                folders = database_folders(folderlist, config, database)
+            else:
+                folders = export_folders(folderlist, config, cache)
+            for folder, columns, entry in folders:
+                if entry is not None:
+                    new_cache[folder] = entry
+                    cached += entry is cache.get(folder)
+                if columns is None:
+                    continue
+                if header is None:
+                    header = list(columns.keys())
+                    writer.writerow(header)
+                writer.writerows([format_value(value) for value in row]
+                                 for row in zip(*(columns[key] for key in header)))
+                nrows += len(columns['x'])
+
+                if parquet_path:
+                    table = pyarrow.table({key: np.asarray(columns[key]) for key in header})
+                    if parquet_writer is None:
+                        parquet_writer = pyarrow.parquet.ParquetWriter(parquet_path, table.schema)
+                    parquet_writer.write_table(table.cast(parquet_writer.schema))
+        finally:
+            if parquet_writer is not None:
+                parquet_writer.close()
+
+    if cache_path:
+        write_json_atomic(cache_path, new_cache, indent=None)
+        logging.info('{0} of {1} folders taken from the export cache'.format(cached, len(new_cache)))
+    return nrows
+
+
+# array backed tracking data of all trials, frames and objects of one folder
+class TrackingStore:
+    objects = ('nerve', 'fix')
+
+    def __init__(self, ntrials, n):
+        self.rect = np.zeros((ntrials, n, 2, 4), np.int32)  # x1, y1, x2, y2
+        self.point = np.zeros((ntrials, n, 2, 2), np.int32)  # x, y
+        self.time = np.full((ntrials, n, 2), '', 'U32')
+        self.valid = np.zeros((ntrials, n, 2), bool)
+
+    def __bool__(self):
+        return self.valid.size > 0
+
+    @property
+    def ntrials(self):
+        return self.valid.shape[0]
+
+    @property
+    def n(self):
+        return self.valid.shape[1]
+
+    # nested list layout of tracking.json, frames beyond n are dropped and missing frames stay empty
+    @classmethod
+    def from_json(cls, data, ntrials, n):
+        store = cls(max(ntrials, len(data)), n)
+        for trial, frames in enumerate(data):
+            for k, entry in enumerate(frames[:n]):
+                for o, object in enumerate(cls.objects):
+                    rect = entry[object]['rect']
+                    store.time[trial, k, o] = entry[object].get('time', '')
+                    if rect and entry[object]['point']:
+                        store.set_rect(trial, k, object, rect, store.time[trial, k, o])
+        return store
+
+    def to_json(self):
+        data = []
+        for trial in range(self.ntrials):
+            frames = []
+            for k in range(self.n):
+                entry = {}
+                for object in self.objects:
+                    entry[object] = {'rect': self.get_rect(trial, k, object),
+                                     'point': self.get_point(trial, k, object),
+                                     'time': str(self.time[trial, k, self.objects.index(object)])}
+                frames.append(entry)
+            data.append(frames)
+        return data
+
+    @classmethod
+    def load(cls, path, ntrials, n):
+        with open(path) as f:
+            return cls.from_json(simplejson.load(f), ntrials, n)
+
+    def save(self, path):
+        write_json_atomic(path, self.to_json())
+
+    def get_rect(self, trial, k, object):
+        o = self.objects.index(object)
+        if not self.valid[trial, k, o]:
+            return {}
+        return dict(zip(('x1', 'y1', 'x2', 'y2'), self.rect[trial, k, o].tolist()))
+
+    def get_point(self, trial, k, object):
+        o = self.objects.index(object)
+        if not self.valid[trial, k, o]:
+            return {}
+        return dict(zip(('x', 'y'), self.point[trial, k, o].tolist()))
+
+    def set_rect(self, trial, k, object, rect, timestamp):
+        o = self.objects.index(object)
+        x1, y1, x2, y2 = rect['x1'], rect['y1'], rect['x2'], rect['y2']
+        self.rect[trial, k, o] = (x1, y1, x2, y2)
+        self.point[trial, k, o] = (int((x1 + x2) / 2), int((y1 + y2) / 2))
+        self.time[trial, k, o] = timestamp
+        self.valid[trial, k, o] = True
+
+    def clear(self, trial, k, object):
+        o = self.objects.index(object)
+        self.valid[trial, k, o] = False
+        self.time[trial, k, o] = ''
+
+    def reset_trial(self, trial):
+        self.valid[trial] = False
+        self.time[trial] = ''
+
+    # take over the entries of another store of the same images that were set after the newest own entry,
+    # the other store has at most as many trials. cleared entries have no time, comparing entry by entry
+    # would bring back rectangles that were cleared since
+    def update_newer(self, other):
+        t = other.ntrials
+        newer = other.valid & (other.time > max(self.time.ravel().tolist(), default=''))
+        for own, new in ((self.rect, other.rect), (self.point, other.point), (self.time, other.time),
+                         (self.valid, other.valid)):
+            own[:t][newer] = new[newer]
+        return self
+
+    # trials with a point for every frame and both objects
+    def complete_trials(self):
+        return np.flatnonzero(self.valid.all(axis=(1, 2)))
+
+    # nerve position relative to the fixpoint, as displacement from the first frame, shape (trials, n - 1, 2)
+    def relative_displacement(self, trials):
+        diff = self.point[trials, :, 0] - self.point[trials, :, 1]
+        return diff[:, 1:] - diff[:, :1]
+
+
+DATABASE = 'tracking.sqlite'
+
+
+# the tracking data of all folders of the main folder in one sqlite file, one row per stored rectangle. a
+# save only writes the rows that changed since the folder was last loaded or saved, in one transaction
+class TrackingDatabase:
+    schema = '''
+        CREATE TABLE IF NOT EXISTS folders (
+            folder TEXT PRIMARY KEY,
+            ntrials INTEGER NOT NULL,
+            n INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS tracking (
+            folder TEXT NOT NULL,
+            trial INTEGER NOT NULL,
+            image INTEGER NOT NULL,
+            object TEXT NOT NULL,
+            x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER,
+            x INTEGER, y INTEGER,
+            time TEXT,
+            PRIMARY KEY (folder, trial, image, object)) WITHOUT ROWID;
+    '''
+
+    def __init__(self, walk_dir):
+        self.walk_dir = walk_dir
+        self.path = os.path.join(walk_dir, DATABASE)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.schema)
+        self.lock = threading.Lock()
+        self.saved = {}  # folder -> copies of rect, time and valid as last loaded or saved
+
+    # folders are stored relative to the main folder
+    def key(self, folder):
+        return os.path.relpath(folder, self.walk_dir).replace(os.sep, '/')
+
+    def contains(self, folder):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM folders WHERE folder = ?',
+                                           (self.key(folder),)).fetchone() is not None
+
+    def store(self, ntrials, n, rows):
+        tracking = TrackingStore(ntrials, n)
+        for trial, k, object, x1, y1, x2, y2, x, y, timestamp in rows:
+            if trial < ntrials and k < n:
+                o = TrackingStore.objects.index(object)
+                tracking.rect[trial, k, o] = (x1, y1, x2, y2)
+                tracking.point[trial, k, o] = (x, y)
+                tracking.time[trial, k, o] = timestamp
+                tracking.valid[trial, k, o] = True
+        return tracking
+
+    def load(self, folder, ntrials, n):
+        with self.lock:
+            row = self.connection.execute('SELECT ntrials FROM folders WHERE folder = ?',
+                                          (self.key(folder),)).fetchone()
+            rows = self.connection.execute('SELECT trial, image, object, x1, y1, x2, y2, x, y, time FROM tracking '
+                                           'WHERE folder = ?', (self.key(folder),)).fetchall()
+        tracking = self.store(max(ntrials, row[0] if row else 0), n, rows)
+        self.snapshot(folder, tracking)
+        return tracking
+
+    # stores of the given folders ({folder: n}) read in a single query
+    def load_all(self, folders):
+        keys = {self.key(folder): folder for folder in folders}
+        rows = {}
+        with self.lock:
+            ntrials = dict(self.connection.execute('SELECT folder, ntrials FROM folders'))
+            for row in self.connection.execute('SELECT * FROM tracking ORDER BY folder, trial, image, object'):
+                if row[0] in keys:
+                    rows.setdefault(row[0], []).append(row[1:])
+        return {folder: self.store(ntrials[key], folders[folder], rows.get(key, []))
+                for key, folder in keys.items() if key in ntrials}
+
+    def snapshot(self, folder, tracking):
+        self.saved[folder] = (tracking.rect.copy(), tracking.time.copy(), tracking.valid.copy())
+
+    # write the changed rows of a folder, the caller holds the lock and the transaction
+    def write(self, folder, tracking):
+        key = self.key(folder)
+        old = self.saved.get(folder)
+        if old is not None and old[2].shape == tracking.valid.shape:
+            rect, timestamps, valid = old
+            changed = (valid != tracking.valid) | (tracking.valid & ((rect != tracking.rect).any(axis=-1) |
+                                                                     (timestamps != tracking.time)))
+        else:
+            self.connection.execute('DELETE FROM tracking WHERE folder = ?', (key,))
+            changed = tracking.valid
+        self.connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)', (key, tracking.ntrials, tracking.n))
+
+        trial, k, o = np.nonzero(changed)
+        stored = tracking.valid[trial, k, o]
+        objects = np.array(TrackingStore.objects)[o]
+        self.connection.executemany('DELETE FROM tracking WHERE folder = ? AND trial = ? AND image = ? AND object = ?',
+                                    zip([key] * len(trial), trial[~stored].tolist(), k[~stored].tolist(),
+                                        objects[~stored].tolist()))
+        trial, k, o, objects = trial[stored], k[stored], o[stored], objects[stored]
+        self.connection.executemany('INSERT OR REPLACE INTO tracking VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    zip([key] * len(trial), trial.tolist(), k.tolist(), objects.tolist(),
+                                        *tracking.rect[trial, k, o].T.tolist(), *tracking.point[trial, k, o].T.tolist(),
+                                        tracking.time[trial, k, o].tolist()))
+        self.snapshot(folder, tracking)
+
+    def save(self, folder, tracking):
+        with self.lock, self.connection:
+            self.write(folder, tracking)
+
+    # copy the tracking.json files of the given folders ({folder: n}) into the database, one transaction.
+    # of a folder already in the database only rectangles set after its last change are taken over, so
+    # edits and batch results in the database are kept
+    def import_json(self, folders):
+        stores = {}
+        for folder, n in folders.items():
+            path = os.path.join(folder, 'tracking.json')
+            if not os.path.exists(path):
+                continue
+            try:
+                tracking = TrackingStore.load(path, 0, n)
+            except (ValueError, KeyError, IndexError, TypeError) as err:
+                logging.error('Cannot read ' + path + ': ' + format(err))
+                continue
+            if self.contains(folder):
+                tracking = self.load(folder, tracking.ntrials, n).update_newer(tracking)
+            else:
+                self.saved.pop(folder, None)
+            stores[folder] = tracking
+        with self.lock, self.connection:
+            for folder, tracking in stores.items():
+                self.write(folder, tracking)
+        return len(stores)
+
+    # write tracking.json files of the given folders ({folder: n}) from the database
+    def export_json(self, folders):
+        stores = self.load_all(folders)
+        for folder, tracking in stores.items():
+            write_json_atomic(os.path.join(folder, 'tracking.json'), tracking.to_json())
+        return len(stores)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
 
 
 # main image tracking class
@@ -22,41 +1235,83 @@ class UltrasoundTracking:
 
     def __init__(self, config):
         self.config = config
+        self.frame_cache = FrameCache(float(config.get('frame_cache_mb', FRAME_CACHE_MB)) * 2 ** 20)
+        self.use_stack = config.get('frame_stack', 'no').lower() in ('yes', 'true', '1')
+        if config.get('profile_log'):
+            PROFILER.open_log(config['profile_log'])
+        self.stack = None
+        self.preprocess = preprocess_params(config)  # None tracks on the frames as they are shown
+        self.prepared = None  # preprocessed frames of the current folder, created on first tracking
+        self.next_source = None  # (folder, images, frame source) of the folder after the current one
+        self.roi_margin = float(config.get('roi_margin', 0))  # 0 tracks on the full frame
+        self.retrack_tolerance = float(config.get('retrack_tolerance', RETRACK_TOLERANCE))
+        self.retrack_backward = config.get('retrack_backward', 'no').lower() in ('yes', 'true', '1')
         self.parse_walkdir()
+        self.database = None
+        if config.get('database', 'no').lower() in ('yes', 'true', '1'):
+            # folders not yet in the database are read from tracking.json once
+            self.database = TrackingDatabase(self.walk_dir)
         self.drawing = False  # true if mouse is pressed
         self.mode = True  # if True, draw rectangle for object, else for fixpoint
         self.manual = False  # if True, draw rectangles manual without tracking
+        self.joint = False  # if True, track object and fixpoint together once both are drawn
         self.helpflag = False  # if True, show helpscreen
+        self.profile_overlay = False  # if True, show recent timings of the hot paths in the status window
         self.ix, self.iy = -1, -1
         self.x, self.y = 10, 10
+        self.cvobj = None  # display buffer, self.frame holds the undecorated image
+        self.dirty = set()  # windows that changed since they were last shown
+        self.pending_move = None  # latest mouse position while drawing, applied once per refresh
         self.kfold = 0
         self.kfile = 0
         self.trial = 0
         self.tracker_type = TRACKER_TYPES[1]
+        self.tracking_latency = []  # seconds per tracker.update of the last tracking run
+        self.job = None  # tracking running in the background
+        self.comparison = None  # results of the last tracker comparison in this folder
         self.nfolder = self.folderlist.__len__()
+
+        # the plot window is created by init_plot once the first image is shown, one line and scatter artist
+        # per trial are kept and updated in place
+        self.figure = None
+        self.axes = None
+        self.plot_artists = {}
+        self.plot_data = {}
+        self.plot_pending = False
+        self.plot_time = 0.
+        self.plot_interval = float(config.get('plot_interval', PLOT_INTERVAL))
+
         self.reload_folder()
         self.read_tracking()
         self.reload_image()
-        self.plot_distance()
         self.helpscreen = self.draw_helpscreen()
 
-        # init plotting
-        plt.style.use('seaborn-whitegrid')
-        plt.ion()
-        plt.ylim((-10, 10))
-        plt.xlim((-10, 10))
-        plt.show()
-
     def parse_walkdir(self):
         # set walking directory
         self.walk_dir = os.path.abspath(self.config['folder'])
-        self.folderlist = []
-        for root, subdirs, files in os.walk(self.walk_dir):
-            if not subdirs:
-                self.folderlist.append(root)
+        self.manifest = DatasetManifest(self.walk_dir, self.config['image_format'])
+        if self.manifest.load():
+            # start from the saved manifest and pick up changes in the background
+            threading.Thread(target=self.manifest.refresh, daemon=True).start()
+        else:
+            self.manifest.refresh()
+        self.folderlist = self.manifest.folderlist
+
+    # adopt the folder list of a finished background refresh, staying on the current folder
+    def sync_folderlist(self):
+        folderlist = self.manifest.folderlist
+        if folderlist is not self.folderlist and folderlist:
+            self.folderlist = folderlist
+            self.nfolder = self.folderlist.__len__()
+            if self.folder in self.folderlist:
+                self.kfold = self.folderlist.index(self.folder)
+            else:
+                self.kfold = min(self.kfold, self.nfolder - 1)
 
+    @profiled('reload_status')
     def reload_status(self):
         self.status = np.zeros((512, 700, 3), np.uint8)
+        self.dirty.add('status')
         font = cv2.FONT_HERSHEY_SIMPLEX
 
         nervepoint = self.get_point('nerve')
@@ -78,10 +1333,25 @@ class UltrasoundTracking:
         cv2.putText(self.status, 'fixY:', (10, 370), font, 1, WHITE, 2, cv2.LINE_AA)
 
         cv2.putText(self.status, 'Tracker:', (10, 440), font, 1, WHITE, 2, cv2.LINE_AA)
-        cv2.putText(self.status, self.tracker_type, (150, 440), font, 1, WHITE, 2, cv2.LINE_AA)
+        cv2.putText(self.status, self.tracker_type + (' JOINT' if self.joint else ''), (150, 440), font, 1, WHITE,
+                    2, cv2.LINE_AA)
 
         cv2.putText(self.status, "Press 'h' to toggle help", (10, 500), font, .5, WHITE, 1, cv2.LINE_AA)
 
+        if self.job is not None:
+            progress = self.job.done / max(self.job.total, 1)
+            cv2.rectangle(self.status, (10, 455), (300, 470), WHITE, 1)
+            cv2.rectangle(self.status, (10, 455), (10 + int(290 * progress), 470), GREEN, -1)
+            cv2.putText(self.status, "{0} / {1}  'x' to cancel".format(self.job.done, self.job.total), (310, 468),
+                        font, .4, WHITE, 1, cv2.LINE_AA)
+
+        if self.profile_overlay:
+            cv2.putText(self.status, 'last / mean / max ms', (490, 80), font, .4, WHITE, 1, cv2.LINE_AA)
+            for k, (name, values) in enumerate(sorted(PROFILER.stats().items())):
+                cv2.putText(self.status, name, (490, 105 + 35 * k), font, .4, YELLOW, 1, cv2.LINE_AA)
+                cv2.putText(self.status, '{0:.1f} / {1:.1f} / {2:.1f}'.format(*values), (490, 120 + 35 * k), font,
+                            .4, WHITE, 1, cv2.LINE_AA)
+
         if nervepoint:
             x, y = nervepoint.values()
             cv2.putText(self.status, str(x), (150, 200), font, 1, WHITE, 2, cv2.LINE_AA)
@@ -131,149 +1401,142 @@ class UltrasoundTracking:
                               (xstart + space + 2 * rectwidth + 5,
                                ystart + rectheight + (rectspace + rectheight) * (self.n - 1) + 5), YELLOW, 2)
 
-            # test = self.gather_points()
             self.draw_arrow(xstart - 40, ystart + int(rectheight / 2) + self.kfile * (rectheight + rectspace))
 
     def draw_arrow(self, x, y):
         length = 20
         cv2.arrowedLine(self.status, (x, y), (x + length, y), WHITE, 2, tipLength=.5)
 
-    def gather_points(self):
-        dflist = []
-        for trial in range(self.ntrials):
-            for object in ['nerve', 'fix']:
-                for k in range(self.n):
-                    tstamp = self.tracking[trial][k][object]['time']
-                    points = dict(self.tracking[trial][k][object]['point'])
-                    if points:
-                        points.update(self.parse_folder_to_vars())
-                        points['folder'] = self.folder
-                        points['trial'] = trial + 1
-                        points['time'] = tstamp
-                        points['file'] = self.imglist[k]
-                        points['image_no'] = k + 1
-                        points['object'] = object
-                        dflist.append(points)
-                    # self.tracking[self.trial][k]['fix']['point']
-        df = pd.DataFrame(dflist)
-        return df
-
     def export_data(self):
-        temp = []
-        for k in range(self.nfolder):
-            temp.append(self.gather_points())
-            self.next_folder()
-
-        out_df = pd.concat(temp)
-        out_df[['x', 'y']] = out_df[['x', 'y']] * float(self.config['scaling_factor'])
+        self.write_tracking()
+        parquet_path = None
+        if self.config.get('export_parquet', 'no').lower() in ('yes', 'true', '1'):
+            parquet_path = os.path.join(self.config['folder'], 'results.parquet')
         try:
-            out_df.to_csv(os.path.join(self.config['folder'], 'results.csv'), sep=";", decimal=",", index=False)
+            nrows = export_results(self.folderlist, self.config, os.path.join(self.config['folder'], 'results.csv'),
+                                   parquet_path, os.path.join(self.config['folder'], 'results_cache.json'),
+                                   self.database)
         except PermissionError as err:
             logging.error('Cannot access output file: ' + format(err))
         else:
-            logging.info('Output successfully written.')
+            logging.info('Output successfully written ({0} rows).'.format(nrows))
 
-    def parse_folder_to_vars(self):
-        vars = self.config['variables'].values()
-        varvals = self.folder.split('\\')[-len(vars):]
-        var_dict = {key: value for key, value in zip(vars, varvals)}
-        return var_dict
+    # matplotlib is only imported here, after the first image is on screen
+    @profiled('init_plot')
+    def init_plot(self):
+        import matplotlib.pyplot as plt
+        plt.style.use('seaborn-whitegrid')
+        plt.ion()
+        self.figure, self.axes = plt.subplots()
+        self.axes.set_ylim((-10, 10))
+        self.axes.set_xlim((-10, 10))
+        plt.show()
+        self.plot_distance()
 
+    @profiled('plot_distance')
     def plot_distance(self):
+        if self.figure is None:
+            return
         if self.imglist and self.n > 1:
-            plotted = False
-            df = self.gather_points()
-            plt.clf()
-            pointsize = np.ones(self.n - 1)
-            pointsize[len(pointsize) - 1] = 5
-
-            for trial in range(self.ntrials):
-                status = self.get_trial_status(trial)
-                if all(status['nerve']) & all(status['fix']):
-                    plotted = True
-                    xdiff = np.cumsum(
-                        np.diff(df[(df['object'] == 'nerve') & (df['trial'] == trial + 1)]['x'])) - np.cumsum(np.diff(
-                        df[(df['object'] == 'fix') & (df['trial'] == trial + 1)]['x']))
-                    ydiff = np.cumsum(
-                        np.diff(df[(df['object'] == 'nerve') & (df['trial'] == trial + 1)]['y'])) - np.cumsum(np.diff(
-                        df[(df['object'] == 'fix') & (df['trial'] == trial + 1)]['y']))
-                    plt.plot(xdiff, ydiff, label=trial + 1)
-                    plt.scatter(xdiff, ydiff, s=pointsize * 10)
-                    # plt.pause(0.001)
-
-            if plotted:
-                plt.legend()
-
+            trials = self.tracking.complete_trials()
+            diffs = dict(zip(trials.tolist(), self.tracking.relative_displacement(trials)))
+            changed = False
+
+            for trial in list(self.plot_artists):
+                if trial not in diffs:
+                    for artist in self.plot_artists.pop(trial):
+                        artist.remove()
+                    del self.plot_data[trial]
+                    changed = True
+
+            for trial, diff in diffs.items():
+                data = diff.tobytes()
+                if self.plot_data.get(trial) == data:
+                    continue
+                if trial not in self.plot_artists:
+                    line, = self.axes.plot([], [], label=trial + 1)
+                    scatter = self.axes.scatter([], [], color=line.get_color())
+                    self.plot_artists[trial] = (line, scatter)
+                line, scatter = self.plot_artists[trial]
+                pointsize = np.ones(len(diff))
+                pointsize[-1] = 5
+                line.set_data(diff[:, 0], diff[:, 1])
+                scatter.set_offsets(diff)
+                scatter.set_sizes(pointsize * 10)
+                self.plot_data[trial] = data
+                changed = True
+
+            if changed:
+                legend = self.axes.get_legend()
+                if legend:
+                    legend.remove()
+                if self.plot_artists:
+                    # keep the legend in trial order
+                    lines = [self.plot_artists[trial][0] for trial in sorted(self.plot_artists)]
+                    self.axes.legend(lines, [line.get_label() for line in lines])
+                self.axes.relim()
+                self.axes.autoscale_view()
+                self.plot_pending = True
+        self.flush_plot()
+
+    # redraw the plot window at most every plot_interval seconds, called again from the main loop
+    def flush_plot(self):
+        if self.plot_pending and time.perf_counter() - self.plot_time >= self.plot_interval:
+            self.plot_pending = False
+            self.plot_time = time.perf_counter()
+            self.figure.canvas.draw_idle()
+            self.figure.canvas.flush_events()
+
+    @profiled('write_tracking')
     def write_tracking(self):
-        f = open(os.path.join(self.folder, 'tracking.json'), "w")
-        try:
-            f.write(simplejson.dumps(self.tracking, indent=4))
-        finally:
-            f.close()
+        if self.database is not None:
+            self.database.save(self.folder, self.tracking)
+        else:
+            self.tracking.save(os.path.join(self.folder, 'tracking.json'))
 
     def read_tracking(self):
         self.reload_folder()
         try:
-            f = open(os.path.join(self.folder, 'tracking.json'))
-            self.tracking = simplejson.load(f)
-            f.close()
+            if self.database is not None and self.database.contains(self.folder):
+                self.tracking = self.database.load(self.folder, self.ntrials, self.n)
+            else:
+                self.tracking = TrackingStore.load(os.path.join(self.folder, 'tracking.json'), self.ntrials, self.n)
         except:
             self.reset_tracking()
 
-
         if not self.tracking and self.n > 0:
             self.reset_tracking()
 
     def get_trial_status(self, trial):
-        status = {'nerve': [], 'fix': []}
-        for k in range(self.n):
-            status['nerve'].append(bool(self.tracking[trial][k]['nerve']['point']))
-            status['fix'].append(bool(self.tracking[trial][k]['fix']['point']))
-        return status
+        return {'nerve': self.tracking.valid[trial, :, 0], 'fix': self.tracking.valid[trial, :, 1]}
 
     def reset_tracking(self):
-        self.tracking = []  # trial level
-
-        for trial in range(self.ntrials):
-            self.tracking.append([])  # trial level
-            self.add_trial(trial)
-
+        self.tracking = TrackingStore(self.ntrials, self.n)
         self.write_tracking()
         self.plot_distance()
         self.reload_image()
 
     def reset_trial(self):
-        if self.tracking:
-            self.tracking[self.trial] = []
-            if self.n > 0:
-                self.add_trial(self.trial)
+        if self.tracking and not self.job_busy():
+            self.tracking.reset_trial(self.trial)
             self.write_tracking()
             self.plot_distance()
             self.reload_image()
 
-    def add_trial(self, trial):
-        for k in range(self.n):
-            self.tracking[trial].append(
-                {'nerve': {
-                    'rect': {},
-                    'point': {},
-                    'time': ""
-                },
-                    'fix': {
-                        'rect': {},
-                        'point': {},
-                        'time': ""
-                    }}
-            )
-
     def reload_folder(self):
         if self.folderlist:
+            if self.folderlist[self.kfold] != getattr(self, 'folder', None):
+                self.comparison = None
             self.folder = self.folderlist[self.kfold]
-            self.imglist = []
-            for file in os.listdir(self.folder):
-                if file.endswith(self.config["image_format"]):
-                    self.imglist.append(file)
+            self.source = open_frame_source(self.folder, self.manifest.images(self.folder), self.frame_cache)
+            self.imglist = self.source.names
             self.n = self.imglist.__len__()
+            self.stack = None
+            self.prepared = None
+            if self.imglist and self.use_stack:
+                self.stack = open_frame_stack(self.folder, self.source)
+                if self.stack is None:
+                    self.stack = pack_frame_stack(self.folder, self.source)
         else:
             logging.error('Folder not found.')
             sys.exit()
@@ -283,18 +1546,79 @@ class UltrasoundTracking:
         if self.imglist:
             self.imgfile = self.imglist[self.kfile]
             self.imgpath = os.path.join(self.folder, self.imgfile)
-            self.cvobj = cv2.cvtColor(cv2.imread(self.imgpath, 0), 8)
-            # self.show_ellipse()
-            self.show_rectangle('nerve')
-            self.show_rectangle('fix')
+            self.frame = cv2.cvtColor(self.get_gray(self.kfile), 8)
+            self.prefetch_images()
+            self.render_image()
             self.reload_status()
             self.plot_distance()
         else:
-            self.cvobj = np.zeros((512, 512, 3), np.uint8)
-            self.tracking = []
+            self.frame = np.zeros((512, 512, 3), np.uint8)
+            self.tracking = TrackingStore(self.ntrials, 0)
+            self.render_image()
             self.reload_status()
             logging.error('No images to display with format ' + self.config["image_format"])
 
+    # composite the rectangle overlays onto a reused copy of the pristine frame
+    def render_image(self):
+        if self.cvobj is None or self.cvobj.shape != self.frame.shape:
+            self.cvobj = np.empty_like(self.frame)
+        np.copyto(self.cvobj, self.frame)
+        # self.show_ellipse()
+        self.show_rectangle('nerve')
+        self.show_rectangle('fix')
+        self.dirty.add('image')
+
+    # single channel frame k of the current folder, a slice of the frame stack if there is one
+    def get_gray(self, k):
+        if self.stack is not None:
+            return self.stack[k]
+        return self.source.get(k)
+
+    # frame k of the current folder as the trackers see it. the preprocessed frames of the whole folder are
+    # created once and kept in a cached stack next to tracking.json
+    def get_tracking_gray(self, k):
+        if self.preprocess is None:
+            return self.get_gray(k)
+        if self.prepared is None:
+            self.prepared = open_frame_stack(self.folder, self.source, self.preprocess)
+            if self.prepared is None:
+                with PROFILER.timed('preprocess'):
+                    self.prepared = pack_frame_stack(self.folder, self.source, self.preprocess)
+            if self.prepared is None:
+                # not writable or frames of different size, keep them in memory
+                self.prepared = preprocess_frames(self.source.stream(range(self.n)), self.preprocess)
+        return self.prepared[k]
+
+    # frames in the given order for a tracking run. without a stack they are read from the frame source as
+    # the tracker asks for them, image files through the frame cache and consecutive frames of a multi-frame
+    # file decoded sequentially
+    def tracking_frames(self, indices):
+        if self.preprocess is None and self.stack is None:
+            return self.source.stream(indices)
+        return (self.get_tracking_gray(k) for k in indices)
+
+    # factor between tracker and image coordinates
+    def tracking_scale(self):
+        return self.preprocess['scale'] if self.preprocess else 1.
+
+    def prefetch_images(self):
+        items = []
+        if self.stack is None:
+            items.extend(self.source.prefetch_items([(self.kfile + 1) % self.n, (self.kfile - 1) % self.n]))
+        if self.nfolder > 1:
+            # only the first frames of the next folder, and at most a quarter of the cache, so the next folder
+            # never pushes out the neighbours of the current image
+            frame_bytes = max(self.frame[..., 0].nbytes, 1)
+            count = min(PREFETCH_FOLDER_FRAMES, int(self.frame_cache.max_bytes / 4 // frame_bytes))
+            folder = self.folderlist[(self.kfold + 1) % self.nfolder]
+            images = self.manifest.cached_images(folder)
+            # the frame source of a multi-frame file decides the cache keys of its frames
+            if self.next_source is None or self.next_source[:2] != (folder, images):
+                self.next_source = (folder, images, open_frame_source(folder, images, self.frame_cache))
+            source = self.next_source[2]
+            items.extend(source.prefetch_items(range(min(count, len(source)))))
+        self.frame_cache.prefetch(items)
+
     def next_trial(self):
         global mode
         self.trial += 1
@@ -317,9 +1641,12 @@ class UltrasoundTracking:
         self.reload_image()
 
     def next_folder(self):
+        if self.job_busy():
+            return
         global mode
         mode = True
         self.write_tracking()
+        self.sync_folderlist()
         self.kfold += 1
         self.kfile = 0
         if self.kfold == self.nfolder:
@@ -328,9 +1655,12 @@ class UltrasoundTracking:
         self.reload_image()
 
     def prev_folder(self):
+        if self.job_busy():
+            return
         global mode
         mode = True
         self.write_tracking()
+        self.sync_folderlist()
         self.kfold -= 1
         self.kfile = 0
         if self.kfold == -1:
@@ -338,32 +1668,30 @@ class UltrasoundTracking:
         self.read_tracking()
         self.reload_image()
 
-    def set_rectangle(self, rect, target):
-        x1, y1, x2, y2 = rect.values()
-        self.tracking[self.trial][self.kfile][target]['rect'] = rect
-
-        point = {'x': int((x1 + x2) / 2),
-                 'y': int((y1 + y2) / 2)}
-        self.tracking[self.trial][self.kfile][target]['point'] = point
-
+    def set_rectangle(self, rect, target, kfile=None, trial=None):
+        if kfile is None:
+            kfile = self.kfile
+        if trial is None:
+            trial = self.trial
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.tracking[self.trial][self.kfile][target]['time'] = timestamp
+        self.tracking.set_rect(trial, kfile, target, rect, timestamp)
 
-    def remove_rectangle(self, target):
-        self.tracking[self.trial][self.kfile][target]['rect'] = {}
-        self.tracking[self.trial][self.kfile][target]['point'] = {}
-        self.tracking[self.trial][self.kfile][target]['timestamp'] = ""
-        self.write_tracking()
+    def clear_rectangle(self, target, kfile=None, trial=None):
+        if kfile is None:
+            kfile = self.kfile
+        if trial is None:
+            trial = self.trial
+        self.tracking.clear(trial, kfile, target)
 
     def get_rectangle(self, target):
         if self.tracking:
-            return self.tracking[self.trial][self.kfile][target]['rect']
+            return self.tracking.get_rect(self.trial, self.kfile, target)
         else:
             return {}
 
     def get_point(self, target):
         if self.tracking:
-            return self.tracking[self.trial][self.kfile][target]['point']
+            return self.tracking.get_point(self.trial, self.kfile, target)
         else:
             return {}
 
@@ -389,58 +1717,221 @@ class UltrasoundTracking:
                      (x2, int((y1 + y2) / 2)),
                      RED, 1)
 
-    def track_rectangle(self, target):
+    def load_tracking_frames(self, indices):
+        return list(self.tracking_frames(indices))
 
-        if self.tracker_type == 'BOOSTING':
-            tracker = cv2.TrackerBoosting_create()
-        if self.tracker_type == 'MIL':
-            tracker = cv2.TrackerMIL_create()
-        if self.tracker_type == 'KCF':
-            tracker = cv2.TrackerKCF_create()
-        if self.tracker_type == 'TLD':
-            tracker = cv2.TrackerTLD_create()
-        if self.tracker_type == 'MEDIANFLOW':
-            tracker = cv2.TrackerMedianFlow_create()
-        if self.tracker_type == 'GOTURN':
-            tracker = cv2.TrackerGOTURN_create()
-        if self.tracker_type == 'MOSSE':
-            tracker = cv2.TrackerMOSSE_create()
-        if self.tracker_type == "CSRT":
-            tracker = cv2.TrackerCSRT_create()
-        else:
-            tracker = cv2.TrackerMIL_create()
+    # the current image is the seed, the sequence wraps around to the image before it
+    def tracking_order(self):
+        return [(self.kfile + k) % self.n for k in range(self.n)]
 
+    # run all tracker types on the current rectangle side by side in the tracking worker, store the results in
+    # comparison.json and apply the best one
+    def compare_trackers(self, target):
         rect = self.get_rectangle(target)
-        if rect:
-            x1, y1, x2, y2 = rect.values()
-            bbox = (x1, y1, x2 - x1, y2 - y1)
-
-            if bbox[2] < 0:
-                bbox = (bbox[0] + bbox[2], bbox[1], -bbox[2], bbox[3])
-
-            if bbox[3] < 0:
-                bbox = (bbox[0], bbox[1] + bbox[3], bbox[2], -bbox[3])
-
-            tracker.init(self.cvobj, bbox)
-
-            for k in range(self.n - 1):
-                self.next_image()
-                ok, bbox = tracker.update(self.cvobj)
+        if not rect or self.n < 2 or self.job_busy():
+            return
+        order = self.tracking_order()
+        trial, seed_image = self.trial, self.imglist[self.kfile]
+        margin, scale = self.roi_margin, self.tracking_scale()
+
+        # every tracker checks the cancel flag of the job before each frame, so 'x' stops them all
+        def steps():
+            frames = []
+            for frame in self.tracking_frames(order):
+                if job.cancelled.is_set():
+                    return
+                frames.append(frame)
+            try:
+                for tracker_type, result in iter_comparison(TRACKER_TYPES, frames, rect, margin, scale,
+                                                            job.cancelled):
+                    job.result[tracker_type] = result
+                    yield None, [], []
+            except BaseException:
+                # stop the other trackers instead of waiting for them
+                job.cancel()
+                raise
+
+        def apply():
+            results = {tracker_type: job.result[tracker_type] for tracker_type in TRACKER_TYPES}
+            best = select_tracker(results)
+            for tracker_type, result in results.items():
+                if 'error' in result:
+                    logging.warning('Tracker {0} not available: {1}'.format(tracker_type, result['error']))
+                else:
+                    logging.info('Tracker {0}: {1} failures in {2:.2f} s{3}'.format(
+                        tracker_type, len(result['failures']), result['seconds'],
+                        ' (best)' if tracker_type == best else ''))
+
+            path = os.path.join(self.folder, 'comparison.json')
+            try:
+                with open(path) as f:
+                    comparison = simplejson.load(f)
+            except (OSError, ValueError):
+                comparison = {}
+            comparison['{0}/{1}'.format(trial + 1, target)] = {
+                'seed_image': seed_image,
+                'images': [self.imglist[k] for k in order[1:]],
+                'best': best,
+                'results': results}
+            write_json_atomic(path, comparison)
+            self.comparison = {'trial': trial, 'target': target, 'order': order, 'results': results}
+
+            if best:
+                self.tracker_type = best
+                self.apply_comparison()
+
+        job = TrackingJob('Compared {done} trackers', 'all', steps(), len(TRACKER_TYPES))
+        job.apply = apply
+        self.start_job(job)
+
+    # store the compared rectangles of the selected tracker type
+    def apply_comparison(self):
+        if not self.comparison or self.comparison['trial'] != self.trial or self.job_busy():
+            return
+        result = self.comparison['results'].get(self.tracker_type, {})
+        if 'rects' not in result:
+            logging.warning('No comparison result for tracker ' + self.tracker_type)
+            return
+        target = self.comparison['target']
+        for k, rect in zip(self.comparison['order'][1:], result['rects']):
+            if rect:
+                self.set_rectangle(rect, target, k)
+            else:
+                self.clear_rectangle(target, k)
+        logging.info('Applied {0} results for {1} in trial {2}'.format(self.tracker_type, target, self.trial + 1))
+        self.write_tracking()
+        self.reload_image()
 
-                # Draw bounding box
-                if ok:
-                    # Tracking success
-                    rect = {'x1': int(bbox[0]), 'y1': int(bbox[1]),
-                            'x2': int(bbox[0] + bbox[2]),
-                            'y2': int(bbox[1] + bbox[3])}
-                    self.set_rectangle(rect, target)
-                    logging.info('Successful tracking on image ' + self.imgfile + ' with tracker ' + self.tracker_type)
+    def track_rectangle(self, target):
+        self.track_targets([(self.trial, target)])
+
+    # true if the target has stored rectangles on other images than the current one
+    def has_track(self, target):
+        valid = self.tracking.valid[self.trial, :, TrackingStore.objects.index(target)].copy()
+        valid[self.kfile] = False
+        return valid.any()
+
+    # re-track from a corrected rectangle on the current image through the following (and optionally the
+    # preceding) images, stopping as soon as the new track agrees with the stored rectangles again
+    def retrack_rectangle(self, target):
+        seed = self.get_rectangle(target)
+        if not seed or self.job_busy():
+            return
+        trial, kfile, tracker_type = self.trial, self.kfile, self.tracker_type
+        directions = [range(kfile + 1, self.n)]
+        if self.retrack_backward:
+            directions.append(range(kfile - 1, -1, -1))
+
+        def steps():
+            for indices in directions:
+                frames = self.tracking_frames([kfile] + list(indices))
+                for k, (rects, latencies) in zip(indices, iter_sequence(tracker_type, frames, [seed], self.roi_margin,
+                                                                        self.tracking_scale())):
+                    rect = rects[0]
+                    stored = self.tracking.get_rect(trial, k, target)
+                    if rect and stored and np.hypot(*np.subtract(rect_centre(rect), rect_centre(stored))) <= \
+                            self.retrack_tolerance:
+                        logging.info('Re-tracking converged on image ' + self.imglist[k])
+                        break
+                    yield k, [(trial, target, rect)], latencies
+
+        self.start_job(TrackingJob('Re-tracked {done} images with tracker {tracker}', tracker_type, steps(), sum(map(len, directions))))
+
+    # track both objects, in joint mode also for every trial that has a seed on the current image
+    def track_joint(self, all_trials=False):
+        trials = range(self.ntrials) if all_trials else [self.trial]
+        self.track_targets([(trial, target) for trial in trials for target in TrackingStore.objects])
+
+    # track (trial, target) pairs from their rectangles on the current image in one pass over the frames
+    def track_targets(self, targets):
+        targets = [(trial, target) for trial, target in targets
+                   if self.tracking and self.tracking.get_rect(trial, self.kfile, target)]
+        if not targets or self.n < 2 or self.job_busy():
+            self.write_tracking()
+            self.reload_image()
+            return
+        order = self.tracking_order()
+        seeds = [self.tracking.get_rect(trial, self.kfile, target) for trial, target in targets]
+        frames = self.tracking_frames(order)  # decoded by the worker as it goes
+        tracker_type = self.tracker_type
+
+        def steps():
+            for k, (rects, latencies) in zip(order[1:], iter_sequence(tracker_type, frames, seeds, self.roi_margin,
+                                                                      self.tracking_scale())):
+                yield k, [(trial, target, rect) for (trial, target), rect in zip(targets, rects)], latencies
+
+        self.start_job(TrackingJob('Tracked {done} images with tracker {tracker}', tracker_type, steps(), self.n - 1))
+
+    # true (with a warning) while a tracking job is running, only one runs at a time
+    def job_busy(self):
+        if self.job is None:
+            return False
+        logging.warning("Tracking is still running, press 'x' to cancel it")
+        return True
+
+    def start_job(self, job):
+        # the seed rectangle is saved before the worker starts
+        self.write_tracking()
+        self.job = job
+        self.tracking_latency = job.latencies
+        job.start()
+        self.reload_status()
+
+    # apply the results the tracking worker posted since the last call, called from the main loop
+    def poll_job(self):
+        if self.job is None:
+            return
+        job = self.job
+        redraw = False
+        for step in job.drain():
+            if step is None:
+                self.finish_job()
+                return
+            k, rects, latencies = step
+            for trial, target, rect in rects:
+                if rect:
+                    self.set_rectangle(rect, target, k, trial)
+                    logging.info('Successful tracking on image ' + self.imglist[k] + ' with tracker ' +
+                                 job.tracker_type)
                 else:
-                    # Tracking failure
-                    self.remove_rectangle(target)
-                    logging.error('Tracking error on image ' + self.imgfile + ' with tracker ' + self.tracker_type)
-            self.next_image()
+                    self.clear_rectangle(target, k, trial)
+                    logging.error('Tracking error on image ' + self.imglist[k] + ' with tracker ' +
+                                  job.tracker_type)
+            job.latencies.extend(latencies)
+            job.done += 1
+            redraw = redraw or k == self.kfile
+        if redraw:
+            self.render_image()
+        self.reload_status()
+
+    def finish_job(self):
+        job = self.job
+        self.job = None
+        if job.error is not None:
+            logging.error('Tracking with {0} failed after {1} of {2} steps: {3!r}'.format(
+                job.tracker_type, job.done, job.total, job.error),
+                exc_info=(type(job.error), job.error, job.error.__traceback__))
+        elif job.cancelled.is_set():
+            logging.warning('Tracking cancelled after {0} of {1} steps'.format(job.done, job.total))
+        else:
+            logging.info(job.label.format(done=job.done, tracker=job.tracker_type))
+            if job.apply is not None:
+                job.apply()
+        if job.latencies:
+            logging.info('Tracker {0} update latency: mean {1:.1f} ms, max {2:.1f} ms over {3} updates'.format(
+                job.tracker_type, 1000 * np.mean(job.latencies), 1000 * np.max(job.latencies), len(job.latencies)))
         self.write_tracking()
+        self.reload_image()
+
+    # stop the running tracking job, the images tracked so far are kept. with wait the results are applied
+    # before returning
+    def cancel_job(self, wait=False):
+        if self.job is None:
+            return
+        self.job.cancel()
+        if wait:
+            self.job.join()
+            self.poll_job()
 
     # mouse callback function
     def draw_shape(self, event, x, y, flags, param):
@@ -451,25 +1942,49 @@ class UltrasoundTracking:
             self.ix, self.iy = x, y
 
         elif event == cv2.EVENT_MOUSEMOVE:
-            rect = {'x1': self.ix, 'y1': self.iy,
-                    'x2': x, 'y2': y}
             if self.drawing:
-                if self.mode:
-                    self.set_rectangle(rect, 'nerve')
-                else:
-                    self.set_rectangle(rect, 'fix')
+                self.pending_move = (x, y)
 
         elif event == cv2.EVENT_LBUTTONUP:
+            self.apply_pending_move()
             self.drawing = False
-            if not self.manual:
-                if self.mode:
-                    self.track_rectangle('nerve')
+            if self.joint and not self.manual:
+                # wait for both seed boxes on this image, then track them together
+                if self.get_rectangle('nerve') and self.get_rectangle('fix'):
+                    self.track_joint()
                 else:
-                    self.track_rectangle('fix')
-            self.write_tracking()
-            self.plot_distance()
-
-        self.reload_image()
+                    self.mode = not self.mode
+                    self.write_tracking()
+                    self.render_image()
+                    self.reload_status()
+            elif not self.manual:
+                # tracking writes and redraws once when finished, corrections of an existing track only
+                # re-track the images that change
+                target = 'nerve' if self.mode else 'fix'
+                if self.has_track(target):
+                    self.retrack_rectangle(target)
+                else:
+                    self.track_rectangle(target)
+            else:
+                self.write_tracking()
+                self.render_image()
+                self.reload_status()
+                self.plot_distance()
+
+    # update the rubber band rectangle to the last mouse position
+    def apply_pending_move(self):
+        if self.pending_move is None or not self.drawing:
+            return
+        x, y = self.pending_move
+        self.pending_move = None
+        rect = {'x1': self.ix, 'y1': self.iy,
+                'x2': x, 'y2': y}
+        if self.mode:
+            self.set_rectangle(rect, 'nerve')
+        else:
+            self.set_rectangle(rect, 'fix')
+        # only the rubber band changes while dragging
+        self.render_image()
 
     # dummy function
     def nothing(x):
@@ -491,16 +2006,28 @@ class UltrasoundTracking:
                     cv2.LINE_AA)
         cv2.putText(helpscreen, "E:   change selection mode (manual or tracking)", (10, 200), font, .4, WHITE, 1,
                     cv2.LINE_AA)
-        cv2.putText(helpscreen, "1-7:   Select different tracking algorithms", (10, 220), font, .4, WHITE, 1,
+        cv2.putText(helpscreen, "1-9:   Select different tracking algorithms", (10, 220), font, .4, WHITE, 1,
                     cv2.LINE_AA)
+        cv2.putText(helpscreen, "J:   joint mode (track object and fixpoint together once both are drawn)", (10, 240),
+                    font, .4, WHITE, 1, cv2.LINE_AA)
 
-        cv2.putText(helpscreen, "Manipulation:", (10, 250), font, .5, WHITE, 1, cv2.LINE_AA)
-        cv2.putText(helpscreen, "Q:   Reset rectangles for current folder", (10, 270), font, .4, WHITE, 1, cv2.LINE_AA)
-        cv2.putText(helpscreen, "O:   Create output csv file in working folder", (10, 290), font, .4, WHITE, 1,
+        cv2.putText(helpscreen, "Manipulation:", (10, 270), font, .5, WHITE, 1, cv2.LINE_AA)
+        cv2.putText(helpscreen, "Q:   Reset rectangles for current folder", (10, 290), font, .4, WHITE, 1, cv2.LINE_AA)
+        cv2.putText(helpscreen, "O:   Create output csv file in working folder", (10, 310), font, .4, WHITE, 1,
+                    cv2.LINE_AA)
+        cv2.putText(helpscreen, "T:   Track object and fixpoint of all trials from the current image", (10, 330), font,
+                    .4, WHITE, 1, cv2.LINE_AA)
+        cv2.putText(helpscreen, "C:   Compare all trackers on the current rectangle and keep the best", (10, 350), font,
+                    .4, WHITE, 1, cv2.LINE_AA)
+        cv2.putText(helpscreen, "V:   Keep the compared result of the selected tracker instead", (10, 370), font,
+                    .4, WHITE, 1, cv2.LINE_AA)
+        cv2.putText(helpscreen, "P:   Show timings of image loading, saving, plotting and tracking", (10, 390), font,
+                    .4, WHITE, 1, cv2.LINE_AA)
+        cv2.putText(helpscreen, "X:   Cancel the tracking running in the background", (10, 410), font, .4, WHITE, 1,
                     cv2.LINE_AA)
 
         cv2.putText(helpscreen, "WARNING: All changes to rectangles are saved immediately to tracking.json files",
-                    (10, 350), font, .5, YELLOW, 1,
+                    (10, 490), font, .5, YELLOW, 1,
                     cv2.LINE_AA)
 
         return helpscreen